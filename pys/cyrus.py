@@ -6,8 +6,10 @@ import shutil
 import subprocess
 import sys
 import tarfile
+import threading
 import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 from hashlib import sha1
 
@@ -38,6 +40,8 @@ MOD_DIR = PWD_DIR + "local/sub/"
 ROM_DIR = PWD_DIR
 SETUP_JSON = PWD_DIR + "local/set/setup.json"
 MAGISK_JSON = PWD_DIR + "local/set/magisk.json"
+# 直接从 zip 中读取 payload.bin 时, 工程的 DNA_input 里记录 zip 路径的文件
+PAYLOAD_ROM = "payload_rom.txt"
 ostype = platform.system()
 if os.getenv('PREFIX'):
     if "com.termux" in os.getenv('PREFIX'):
@@ -892,7 +896,7 @@ def boot_utils(source, distance, flag=1):
         dboot(source, distance)
 
 
-def decompress_img(source, distance, keep=1):
+def decompress_img(source, distance, keep=1, budget=None):
     if os.path.basename(source) in ('dsp.img', 'exaid.img', 'cust.img'):
         return
     s_time = time.time()
@@ -912,16 +916,15 @@ def decompress_img(source, distance, keep=1):
         if os.path.isfile(new_source):
             if keep == 0:
                 os.remove(source)
-            decompress_img(new_source, distance)
+            decompress_img(new_source, distance, budget=budget)
     if file_type in ['ext', 'erofs', 'super']:
         if file_type != 'ext':
             display(f'正在分解: {os.path.basename(source)} <{file_type}>', 3)
-        if not os.path.isdir(V.config):
-            os.makedirs(V.config)
+        os.makedirs(V.config, exist_ok=True)
         if file_type == 'ext':
             with Console().status(f"[yellow]正在提取{os.path.basename(source)}[/]"):
                 try:
-                    imgextractor.ULTRAMAN().MONSTER(source, distance)
+                    imgextractor.ULTRAMAN(budget=budget).MONSTER(source, distance)
                 except:
                     shutil.rmtree(distance)
                     os.unlink(source)
@@ -935,7 +938,11 @@ def decompress_img(source, distance, keep=1):
                     except Exception as e:
                         print("Error moving file:", e)
                     source = source.replace('.unsparse', '')
-                call(f'extract.erofs -i {source.replace(os.sep, "/")} -o {V.main_dir} -x')
+                if budget:
+                    with budget:
+                        call(f'extract.erofs -i {source.replace(os.sep, "/")} -o {V.main_dir} -x')
+                else:
+                    call(f'extract.erofs -i {source.replace(os.sep, "/")} -o {V.main_dir} -x')
             elif file_type == 'super':
                 lpunpack.unpack(source,V.input )
                 for img in glob(V.input + '*_*.img'):
@@ -979,10 +986,16 @@ def decompress_img(source, distance, keep=1):
                             '.img', '') + '_fsconfig.txt'
                         shutil.copy(contexts, new_contexts)
                         shutil.copy(fsconfig, new_fsconfig)
-                        shutil.rmtree(V.main_dir + 'config')
-                    else:
-                        if os.path.isdir(V.main_dir + 'config'):
-                            shutil.rmtree(V.main_dir + 'config')
+                    # 其它镜像可能正在同时分解到同一个 config 目录, 只删除本镜像的配置, 目录空了再删除
+                    for suffix in ('_file_contexts', '_fs_config', '_fs_options'):
+                        config_file = V.main_dir + 'config' + os.sep + os.path.basename(source).replace(
+                            '.unsparse.img', '').replace('.img', '') + suffix
+                        if os.path.isfile(config_file):
+                            os.remove(config_file)
+                    try:
+                        os.rmdir(V.main_dir + 'config')
+                    except OSError:
+                        ...
 
         if os.path.isdir(distance):
             print('\x1b[1;32m %ds Done\x1b[0m' % (time.time() - s_time))
@@ -1044,25 +1057,47 @@ def decompress_bro(transfer, source, distance, keep=0):
         print("\x1b[1;31m [Failed]\x1b[0m")
 
 
-def decompress_bin(infile, outdir, flag='1'):
+def decompress_bin(infile, outdir, flag='1', member=None):
     os.system("cls" if os.name == "nt" else "clear")
     if flag == "1":
         print(f"> {YELLOW}包含的所有镜像文件: {CLOSE}\n")
-        payload_partitions = extract_payload.info(infile).split()
+        payload_partitions = extract_payload.info(infile, member=member).split()
         partitions = input(
             f"> {RED}根据以上信息输入一个或多个镜像，以空格分开{CLOSE}\n> {MAGENTA}").split()
         print("\n")
         for part in partitions:
             if part in payload_partitions:
-                extract_payload.run(infile, outdir, part)
+                extract_payload.run(infile, outdir, part, member=member)
     else:
         print(f"> {YELLOW}提取【{os.path.basename(infile)}】所有镜像文件:{CLOSE}\n")
-        extract_payload.main(infile, outdir)
-        j = input('> 是否继续分解img [0/1]: ') == 1
-        if j != 1:
+        if input('> 是否继续分解img [0/1]: ') != '1':
+            extract_payload.main(infile, outdir, member=member)
             return
-        for img in glob(V.input + '*.img'):
-            decompress_img(img, V.main_dir + os.path.basename(img).rsplit('.', 1)[0], keep=0)
+        # ext/erofs 镜像提取完成后立即分解, 写入文件 (或运行 extract.erofs) 时与其余镜像的提取共用同一份线程额度;
+        # boot/super 等镜像会切换工作目录或等待输入, 全部提取完成后再依次分解
+        workers = os.cpu_count() or 1
+        budget = threading.BoundedSemaphore(workers)
+        unpacks = []
+        deferred = []
+
+        def unpack(img):
+            decompress_img(img, V.main_dir + os.path.basename(img).rsplit('.', 1)[0], keep=0, budget=budget)
+
+        def partition_done(img):
+            if gettype.gettype(img) in ('ext', 'erofs'):
+                unpacks.append((img, executor.submit(unpack, img)))
+            else:
+                deferred.append(img)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            extract_payload.main(infile, outdir, member=member, budget=budget, on_partition_done=partition_done)
+        for img, future in unpacks:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"> {RED}分解失败: {os.path.basename(img)}: {e}{CLOSE}")
+        for img in deferred:
+            unpack(img)
 
 
 def appendf(msg, log):
@@ -1194,13 +1229,21 @@ def extract_zrom(rom):
         input('> 破损的zip或不支持的zip类型')
         return
     if 'payload.bin' in zip_lists:
-        print(f'> 解压缩: {os.path.basename(rom)}')
         envelop_project()
-        fantasy_zip.close()
-        if os.path.isfile(V.input + 'payload.bin'):
-            decompress_bin(fantasy_zip.extract('payload.bin', V.input), V.input,
-                           input(f'> {RED}选择提取方式:  [0]全盘提取  [1]指定镜像{CLOSE} >> '))
-            menu_main()
+        if fantasy_zip.getinfo('payload.bin').compress_type == zipfile.ZIP_STORED:
+            # Stored payloads are read straight out of the zip, no copy on disk. The project remembers the zip so
+            # the payload can be extracted again from the project menu.
+            fantasy_zip.close()
+            with open(V.input + PAYLOAD_ROM, 'w', encoding='utf-8') as f:
+                f.write(os.path.abspath(rom))
+            decompress_bin(rom, V.input, input(f'> {RED}选择提取方式:  [0]全盘提取  [1]指定镜像{CLOSE} >> '),
+                           member='payload.bin')
+        else:
+            print(f'> 解压缩: {os.path.basename(rom)}')
+            payload = fantasy_zip.extract('payload.bin', V.input)
+            fantasy_zip.close()
+            decompress_bin(payload, V.input, input(f'> {RED}选择提取方式:  [0]全盘提取  [1]指定镜像{CLOSE} >> '))
+        menu_main()
     elif 'run.sh' in zip_lists:
         if not os.path.isdir(MOD_DIR):
             os.makedirs(MOD_DIR)
@@ -1549,11 +1592,16 @@ def menu_main():
             menu_actions[int(option)]()
         elif int(option) == 1:
             infile = V.input + 'payload.bin'
+            member = None
+            if not os.path.exists(infile) and os.path.isfile(V.input + PAYLOAD_ROM):
+                with open(V.input + PAYLOAD_ROM, encoding='utf-8') as f:
+                    infile = f.read().strip()
+                member = 'payload.bin'
             if not os.path.exists(infile):
                 input("未发现Payload.Bin")
             else:
                 decompress_bin(infile, V.input,
-                               input(f'> {RED}选择提取方式:  [0]全盘提取  [1]指定镜像{CLOSE} >> '))
+                               input(f'> {RED}选择提取方式:  [0]全盘提取  [1]指定镜像{CLOSE} >> '), member=member)
         elif int(option) in [2, 3, 4]:
             quiet()
             decompress(glob(V.input + {2: "*.br", 3: "*.new.dat", 4: "*.img"}[int(option)]), int(option))
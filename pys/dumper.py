@@ -1,18 +1,61 @@
 #!/usr/bin/env python
+import bisect
 import bz2
+import errno
+import hashlib
+import io
+import json
 import lzma
+import mmap
+import os
+import queue
+import shutil
 import struct
-import sys
 import threading
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import time
+import zipfile
+from array import array
+from collections import OrderedDict
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from multiprocessing import cpu_count
+from urllib.parse import urlparse
 
+import requests
 import zstandard
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from pys import lpmake
 from pys import update_metadata_pb2 as um
+from pys import verity
 
 flatten = lambda l: [item for sublist in l for item in sublist]
 
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+BACKENDS = ("thread", "process")
+HASH_CHUNK = 1 << 20
+COPY_CHUNK = 1 << 20
+# Android sparse image format
+SPARSE_HEADER_MAGIC = 0xED26FF3A
+CHUNK_TYPE_RAW = 0xCAC1
+CHUNK_TYPE_FILL = 0xCAC2
+CHUNK_TYPE_DONT_CARE = 0xCAC3
+SPARSE_MAX_RAW_BLOCKS = 16384
+# Compressor ids of the BSDF2 patch header
+BSDIFF_NONE, BSDIFF_BZ2, BSDIFF_BROTLI = range(3)
+INSPECT_CACHE_VERSION = 1
+# Remote payloads: operation data closer than FETCH_GAP is fetched in one request of at most FETCH_CHUNK bytes
+FETCH_GAP = 1 << 16
+FETCH_CHUNK = 1 << 24
+
+
+class VerificationError(Exception):
+    ...
+
 
 def u32(x):
     return struct.unpack(">I", x)[0]
@@ -22,86 +65,1430 @@ def u64(x):
     return struct.unpack(">Q", x)[0]
 
 
+O_BINARY = getattr(os, 'O_BINARY', 0)
+
+if hasattr(os, 'pread'):
+    pread = os.pread
+    _pwrite = os.pwrite
+else:
+    # Windows has no positional I/O, emulate it with a lock around lseek
+    _seek_lock = threading.Lock()
+
+    def pread(fd, length, offset):
+        with _seek_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.read(fd, length)
+
+    def _pwrite(fd, data, offset):
+        with _seek_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.write(fd, data)
+
+
+def pwrite(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        written = _pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+# Errors copy_file_range gives for file pairs or filesystems it can't handle, the copy then goes through userspace
+COPY_FALLBACK_ERRORS = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.EBADF, errno.EPERM}
+
+
+def copy_range(src_fd, src_offset, dst_fd, dst_offset, length):
+    """Copies bytes between two files at explicit offsets, inside the kernel where os.copy_file_range allows."""
+    if hasattr(os, 'copy_file_range'):
+        while length:
+            try:
+                copied = os.copy_file_range(src_fd, dst_fd, length, src_offset, dst_offset)
+            except OSError as e:
+                if e.errno not in COPY_FALLBACK_ERRORS:
+                    raise
+                break
+            if not copied:
+                raise EOFError(f"Unexpected end of file at offset {src_offset:d}")
+            src_offset += copied
+            dst_offset += copied
+            length -= copied
+    while length:
+        data = pread(src_fd, min(length, COPY_CHUNK), src_offset)
+        if not data:
+            raise EOFError(f"Unexpected end of file at offset {src_offset:d}")
+        pwrite(dst_fd, data, dst_offset)
+        src_offset += len(data)
+        dst_offset += len(data)
+        length -= len(data)
+
+
+class OperationTable:
+    """Operations of one partition as flat columns, built in one pass over the manifest.
+
+    Extents are flattened into start_block, num_blocks pairs: operation i owns the pairs dst_index[i] to
+    dst_index[i + 1] of dst_extents, likewise for src. Nothing refers back to the protobuf manifest.
+    """
+    NO_HASH = bytes(32)
+
+    def __init__(self, partition, data_offset):
+        self.name = partition.partition_name
+        self.size = partition.new_partition_info.size
+        self.hash = partition.new_partition_info.hash
+        self.types = array('B')
+        # Absolute offsets into the payload file
+        self.data_offsets = array('Q')
+        self.data_lengths = array('Q')
+        # 32 bytes per operation, all zeros when the manifest has no hash
+        self.data_hashes = bytearray()
+        self.src_hashes = bytearray()
+        self.dst_index = array('Q', [0])
+        self.dst_extents = array('Q')
+        self.src_index = array('Q', [0])
+        self.src_extents = array('Q')
+        # End of the furthest dst extent, in blocks
+        self.dst_end = 0
+        # dm-verity layout, (start_block, num_blocks) extents or None when the partition has none
+        extent = lambda name: ((getattr(partition, name).start_block, getattr(partition, name).num_blocks)
+                               if partition.HasField(name) else None)
+        self.hash_tree_data_extent = extent("hash_tree_data_extent")
+        self.hash_tree_extent = extent("hash_tree_extent")
+        self.hash_tree_algorithm = partition.hash_tree_algorithm
+        self.hash_tree_salt = partition.hash_tree_salt
+        self.fec_data_extent = extent("fec_data_extent")
+        self.fec_extent = extent("fec_extent")
+        self.fec_roots = partition.fec_roots
+        for op in partition.operations:
+            self.types.append(op.type)
+            self.data_offsets.append(data_offset + op.data_offset)
+            self.data_lengths.append(op.data_length)
+            self.data_hashes += op.data_sha256_hash or self.NO_HASH
+            self.src_hashes += op.src_sha256_hash or self.NO_HASH
+            for ext in op.dst_extents:
+                self.dst_extents.append(ext.start_block)
+                self.dst_extents.append(ext.num_blocks)
+                self.dst_end = max(self.dst_end, ext.start_block + ext.num_blocks)
+            self.dst_index.append(len(self.dst_extents) // 2)
+            for ext in op.src_extents:
+                self.src_extents.append(ext.start_block)
+                self.src_extents.append(ext.num_blocks)
+            self.src_index.append(len(self.src_extents) // 2)
+
+    def __len__(self):
+        return len(self.types)
+
+    @staticmethod
+    def pairs(extents, index, i):
+        flat = extents[2 * index[i]:2 * index[i + 1]]
+        return list(zip(flat[0::2], flat[1::2]))
+
+    def dst(self, i):
+        return self.pairs(self.dst_extents, self.dst_index, i)
+
+    def src(self, i):
+        return self.pairs(self.src_extents, self.src_index, i)
+
+    def dst_blocks(self, i):
+        return sum(self.dst_extents[2 * self.dst_index[i] + 1:2 * self.dst_index[i + 1]:2])
+
+    def data_hash(self, i):
+        digest = bytes(self.data_hashes[32 * i:32 * i + 32])
+        return b'' if digest == self.NO_HASH else digest
+
+    def src_hash(self, i):
+        digest = bytes(self.src_hashes[32 * i:32 * i + 32])
+        return b'' if digest == self.NO_HASH else digest
+
+
+class SparseLayout:
+    """Android sparse image layout of a partition.
+
+    Chunks only depend on the dst_extents and types of the operations, so the whole layout is fixed before any data
+    is decoded and operations can write their RAW data straight into place in any order.
+    """
+    header = struct.Struct("<I4H4I")
+    chunk_header = struct.Struct("<2H2I")
+
+    def __init__(self, extents, block_size, size):
+        # extents are (start_block, num_blocks, chunk_type) of everything written to the image
+        self.block_size = block_size
+        self.total_blocks = -(-size // block_size)
+        extents = sorted(extents)
+
+        # [chunk_type, start_block, num_blocks], ordered by block and covering the whole partition
+        self.chunks = []
+        position = 0
+        for start_block, num_blocks, chunk_type in extents:
+            if start_block < position:
+                raise ValueError(f"Overlapping dst_extents at block {start_block:d}")
+            if start_block > position:
+                self.add_chunk(CHUNK_TYPE_DONT_CARE, position, start_block - position)
+            self.add_chunk(chunk_type, start_block, num_blocks)
+            position = start_block + num_blocks
+        if position < self.total_blocks:
+            self.add_chunk(CHUNK_TYPE_DONT_CARE, position, self.total_blocks - position)
+        self.total_blocks = max(self.total_blocks, position)
+
+        self.starts = [chunk[1] for chunk in self.chunks]
+        # File offset of every chunk header, the data of a chunk follows its header
+        self.offsets = []
+        offset = self.header.size
+        for chunk_type, _, num_blocks in self.chunks:
+            self.offsets.append(offset)
+            offset += self.chunk_header.size
+            if chunk_type == CHUNK_TYPE_RAW:
+                offset += num_blocks * block_size
+            elif chunk_type == CHUNK_TYPE_FILL:
+                offset += 4
+        self.file_size = offset
+
+    @staticmethod
+    def table_extents(table, raw_extents=()):
+        """Chunk extents of a partition, raw_extents are written by something other than the operations."""
+        op = um.InstallOperation
+        extents = [(start_block, num_blocks, CHUNK_TYPE_RAW) for start_block, num_blocks in raw_extents]
+        for index, op_type in enumerate(table.types):
+            chunk_type = CHUNK_TYPE_FILL if op_type in (op.ZERO, op.DISCARD) else CHUNK_TYPE_RAW
+            extents.extend((start_block, num_blocks, chunk_type) for start_block, num_blocks in table.dst(index))
+        return extents
+
+    def add_chunk(self, chunk_type, start_block, num_blocks):
+        limit = SPARSE_MAX_RAW_BLOCKS if chunk_type == CHUNK_TYPE_RAW else 0xFFFFFFFF
+        while num_blocks:
+            last = self.chunks[-1] if self.chunks else None
+            if last and last[0] == chunk_type and last[1] + last[2] == start_block and last[2] < limit:
+                count = min(num_blocks, limit - last[2])
+                last[2] += count
+            else:
+                count = min(num_blocks, limit)
+                self.chunks.append([chunk_type, start_block, count])
+            start_block += count
+            num_blocks -= count
+
+    def headers(self):
+        """Yields (file_offset, data) of the file header and every chunk header, FILL values included."""
+        yield 0, self.header.pack(SPARSE_HEADER_MAGIC, 1, 0, self.header.size, self.chunk_header.size,
+                                  self.block_size, self.total_blocks, len(self.chunks), 0)
+        for (chunk_type, _, num_blocks), offset in zip(self.chunks, self.offsets):
+            total_size = self.chunk_header.size
+            if chunk_type == CHUNK_TYPE_RAW:
+                total_size += num_blocks * self.block_size
+            elif chunk_type == CHUNK_TYPE_FILL:
+                total_size += 4
+            header = self.chunk_header.pack(chunk_type, 0, num_blocks, total_size)
+            if chunk_type == CHUNK_TYPE_FILL:
+                header += bytes(4)
+            yield offset, header
+
+    def write_headers(self, fd):
+        for offset, header in self.headers():
+            pwrite(fd, header, offset)
+
+    def matches(self, fd):
+        # True when an existing file has exactly this layout
+        return os.fstat(fd).st_size == self.file_size and \
+            all(pread(fd, len(header), offset) == header for offset, header in self.headers())
+
+    def map(self, start, length):
+        """Yields (chunk_type, file_offset, length) pieces covering a byte range of the raw partition image."""
+        while length > 0:
+            index = bisect.bisect_right(self.starts, start // self.block_size) - 1
+            chunk_type, start_block, num_blocks = self.chunks[index]
+            chunk_start = start_block * self.block_size
+            size = min(length, chunk_start + num_blocks * self.block_size - start)
+            if size <= 0:
+                raise ValueError(f"Offset {start:d} is past the end of the sparse image")
+            yield chunk_type, self.offsets[index] + self.chunk_header.size + start - chunk_start, size
+            start += size
+            length -= size
+
+    def pread(self, fd, length, offset):
+        # Reads the raw partition image back, FILL and DONT_CARE chunks read as zeros
+        return b''.join(pread(fd, size, file_offset) if chunk_type == CHUNK_TYPE_RAW else bytes(size)
+                        for chunk_type, file_offset, size in self.map(offset, length))
+
+
+class SuperSlice:
+    """Where a partition image sits inside a super image, used as the partition's layout.
+
+    Offsets are shifted to the partition's extent in the super image, which may itself be an Android sparse image.
+    """
+
+    def __init__(self, offset, sparse=None):
+        self.offset = offset
+        self.sparse = sparse
+
+    def map(self, start, length):
+        if self.sparse:
+            return self.sparse.map(self.offset + start, length)
+        return [(CHUNK_TYPE_RAW, self.offset + start, length)]
+
+    def pread(self, fd, length, offset):
+        if self.sparse:
+            return self.sparse.pread(fd, length, self.offset + offset)
+        return pread(fd, length, self.offset + offset)
+
+
+class ExtentWriter:
+    def __init__(self, fd, extents, block_size, layout=None):
+        self.fd = fd
+        self.block_size = block_size
+        self.zero_block = bytes(block_size)
+        self.extents = [(start_block * block_size, num_blocks * block_size) for start_block, num_blocks in extents]
+        if layout:
+            # Sparse outputs keep every RAW chunk contiguous, an extent may still span several of them
+            self.extents = [(file_offset, size) for start, length in self.extents
+                            for _, file_offset, size in layout.map(start, length)]
+        self.index = 0
+        self.offset = 0
+
+    def write_blocks(self, data, offset):
+        # Outputs start out as holes, all-zero blocks are left that way instead of being written
+        block_size = self.block_size
+        run = 0
+        for pos in range(0, len(data), block_size):
+            block = data[pos:pos + block_size]
+            if block == self.zero_block[:len(block)]:
+                if run < pos:
+                    pwrite(self.fd, data[run:pos], offset + run)
+                run = pos + block_size
+        if run < len(data):
+            pwrite(self.fd, data[run:], offset + run)
+
+    def next_range(self, size):
+        # Output offset and length of the next piece of at most size bytes
+        if self.index >= len(self.extents):
+            raise ValueError("operation data overflows its dst_extents")
+        start, length = self.extents[self.index]
+        size = min(size, length - self.offset)
+        offset = start + self.offset
+        self.offset += size
+        if self.offset == length:
+            self.index += 1
+            self.offset = 0
+        return offset, size
+
+    def write(self, data):
+        data = memoryview(data)
+        while data:
+            offset, size = self.next_range(len(data))
+            self.write_blocks(data[:size], offset)
+            data = data[size:]
+
+    def copy(self, src_fd, src_offset, length):
+        # Unlike write(), zero blocks are copied as well, the bytes never pass through Python to be compared
+        while length:
+            offset, size = self.next_range(length)
+            copy_range(src_fd, src_offset, self.fd, offset, size)
+            src_offset += size
+            length -= size
+
+
+class PartitionHasher:
+    """SHA-256 of an output image, fed front to back as the operations covering it complete."""
+
+    def __init__(self, fd, size, block_size, layout=None):
+        self.fd = fd
+        self.size = size
+        self.block_size = block_size
+        self.read = layout.pread if layout else pread
+        self.sha256 = hashlib.sha256()
+        self.position = 0
+        # Byte runs that are written but not hashed yet, keyed by their start offset
+        self.written = {}
+        self.lock = threading.Lock()
+
+    def update(self, extents):
+        with self.lock:
+            for start_block, num_blocks in extents:
+                self.written[start_block * self.block_size] = num_blocks * self.block_size
+            while self.position in self.written:
+                self.hash_until(self.position + self.written.pop(self.position))
+
+    def hash_until(self, end):
+        end = min(end, self.size)
+        while self.position < end:
+            length = min(HASH_CHUNK, end - self.position)
+            # Blocks that no operation wrote past the end of the file read as zeros
+            data = self.read(self.fd, length, self.position) or bytes(length)
+            self.sha256.update(data)
+            self.position += len(data)
+
+    def digest(self):
+        with self.lock:
+            self.hash_until(self.size)
+            return self.sha256.digest()
+
+
+class OperationJournal:
+    """Indices of the operations already written to an output image, so an interrupted dump can resume.
+
+    Records are only fsynced every SYNC_OPS operations or SYNC_SECONDS, right after the image itself.
+    """
+    MAGIC = b"DNAJ"
+    SYNC_OPS = 256
+    SYNC_SECONDS = 2
+
+    def __init__(self, path, table, resume=True, sparse=False):
+        self.path = path
+        self.header = self.MAGIC + struct.pack("<IQ?", len(table), table.size, sparse) + table.hash
+        self.done = set()
+        self.length = len(self.header)
+        self.file = None
+        self.out_fd = None
+        self.unsynced = 0
+        self.synced_at = 0
+        if resume and os.path.isfile(path):
+            with open(path, 'rb') as f:
+                data = f.read()
+            if data.startswith(self.header):
+                # A record torn by the kill is simply dropped
+                count = (len(data) - len(self.header)) // 4
+                self.done = set(struct.unpack_from(f"<{count}I", data, len(self.header)))
+                self.length += count * 4
+
+    def start(self, out_fd):
+        self.out_fd = out_fd
+        if self.done:
+            self.file = open(self.path, 'r+b')
+            self.file.truncate(self.length)
+            self.file.seek(self.length)
+        else:
+            self.file = open(self.path, 'wb')
+            self.file.write(self.header)
+        self.synced_at = time.monotonic()
+
+    def record(self, index):
+        self.file.write(struct.pack("<I", index))
+        self.unsynced += 1
+        if self.unsynced >= self.SYNC_OPS or time.monotonic() - self.synced_at >= self.SYNC_SECONDS:
+            self.sync()
+
+    def sync(self):
+        # The image goes first, a journal record must never point at data that is not on disk yet
+        os.fsync(self.out_fd)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.synced_at = time.monotonic()
+
+    def close(self, completed):
+        if completed:
+            self.file.close()
+            os.remove(self.path)
+        else:
+            self.sync()
+            self.file.close()
+
+
+class SourceImage:
+    """Memory-mapped old partition image that diff operations read their src_extents from."""
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDONLY | O_BINARY)
+        size = os.fstat(self.fd).st_size
+        self.map = mmap.mmap(self.fd, size, access=mmap.ACCESS_READ) if size else b''
+
+    def read_extents(self, extents, block_size):
+        return b''.join(self.map[start_block * block_size:(start_block + num_blocks) * block_size]
+                        for start_block, num_blocks in extents)
+
+    def close(self):
+        if self.map:
+            self.map.close()
+        os.close(self.fd)
+
+
+def offtin(buf, offset=0):
+    # bsdiff stores its integers as sign-magnitude little endian
+    value = int.from_bytes(buf[offset:offset + 8], "little")
+    return -(value & 0x7FFFFFFFFFFFFFFF) if value >> 63 else value
+
+
+def add_bytes(diff, old):
+    """Bytewise (diff + old) mod 256, done on big integers so no Python-level loop runs per byte."""
+    length = len(diff)
+    low = int.from_bytes(b'\x7f' * length, "little")
+    high = int.from_bytes(b'\x80' * length, "little")
+    a = int.from_bytes(diff, "little")
+    b = int.from_bytes(old, "little")
+    # Add the low 7 bits of every byte, then fold the top bits in with xor so no carry crosses a byte
+    return (((a & low) + (b & low)) ^ ((a ^ b) & high)).to_bytes(length, "little")
+
+
+def bsdiff_decompress(algorithm, data):
+    if algorithm == BSDIFF_NONE:
+        return data
+    if algorithm == BSDIFF_BZ2:
+        return bz2.decompress(data)
+    if algorithm == BSDIFF_BROTLI:
+        if brotli is None:
+            raise RuntimeError("brotli is required for BROTLI_BSDIFF operations, run: pip install brotli")
+        return brotli.decompress(data)
+    raise ValueError(f"Unknown bsdiff compressor {algorithm:d}")
+
+
+def bspatch(old, patch):
+    """Applies a BSDIFF40 or BSDF2 patch to old and returns the new data."""
+    if patch[:8] == b"BSDIFF40":
+        algorithms = (BSDIFF_BZ2,) * 3
+    elif patch[:5] == b"BSDF2":
+        algorithms = tuple(patch[5:8])
+    else:
+        raise ValueError("Unknown bsdiff patch format")
+    ctrl_len, diff_len, new_size = offtin(patch, 8), offtin(patch, 16), offtin(patch, 24)
+    if ctrl_len < 0 or diff_len < 0 or new_size < 0:
+        raise ValueError("Corrupt bsdiff patch header")
+    ctrl = bsdiff_decompress(algorithms[0], patch[32:32 + ctrl_len])
+    diff = bsdiff_decompress(algorithms[1], patch[32 + ctrl_len:32 + ctrl_len + diff_len])
+    extra = bsdiff_decompress(algorithms[2], patch[32 + ctrl_len + diff_len:])
+
+    new = bytearray(new_size)
+    old_size = len(old)
+    new_pos = old_pos = diff_pos = extra_pos = 0
+    for ctrl_pos in range(0, len(ctrl) - 23, 24):
+        add_len, copy_len, seek_len = offtin(ctrl, ctrl_pos), offtin(ctrl, ctrl_pos + 8), offtin(ctrl, ctrl_pos + 16)
+        if add_len < 0 or copy_len < 0 or new_pos + add_len + copy_len > new_size:
+            raise ValueError("Corrupt bsdiff patch")
+        # Bytes of old outside of it count as zero
+        start, end = max(old_pos, 0), min(old_pos + add_len, old_size)
+        if start < end:
+            window = bytes(start - old_pos) + old[start:end] + bytes(old_pos + add_len - end)
+        else:
+            window = bytes(add_len)
+        new[new_pos:new_pos + add_len] = add_bytes(diff[diff_pos:diff_pos + add_len], window)
+        new_pos += add_len
+        old_pos += add_len
+        diff_pos += add_len
+        new[new_pos:new_pos + copy_len] = extra[extra_pos:extra_pos + copy_len]
+        new_pos += copy_len
+        extra_pos += copy_len
+        old_pos += seek_len
+    return new
+
+
+def zip_member_offset(f, member):
+    """Returns the absolute offset of a stored (uncompressed) zip member's data in an open zip file."""
+    path = getattr(f, 'name', 'zip')
+    with zipfile.ZipFile(f) as zip_file:
+        info = zip_file.getinfo(member)
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError(f"{member} is compressed inside {path} and cannot be read in place")
+    f.seek(info.header_offset)
+    header = f.read(30)
+    if header[:4] != b'PK\x03\x04':
+        raise zipfile.BadZipFile(f"Bad local file header for {member} in {path}")
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    return info.header_offset + 30 + name_length + extra_length
+
+
+def source_blocks(table, indices):
+    """One byte per block of the source image, set for the blocks the given operations read."""
+    extents = [extent for index in indices for extent in table.src(index)]
+    needed = bytearray(max((start_block + num_blocks for start_block, num_blocks in extents), default=0))
+    for start_block, num_blocks in extents:
+        needed[start_block:start_block + num_blocks] = b'\x01' * num_blocks
+    return needed
+
+
+def is_url(path):
+    return isinstance(path, str) and path.startswith(("http://", "https://"))
+
+
+def http_get_range(session, url, start, length, stream=False):
+    response = session.get(url, headers={"Range": f"bytes={start:d}-{start + length - 1:d}"}, stream=stream)
+    response.raise_for_status()
+    if response.status_code != 206:
+        response.close()
+        raise IOError(f"{url} does not support HTTP Range requests")
+    return response
+
+
+class HttpFile(io.RawIOBase):
+    """Seekable read-only file over HTTP Range requests, enough for zipfile and the payload header.
+
+    Reads are rounded up to READAHEAD bytes, so the many small reads of zipfile and the manifest
+    parser cost a few requests.
+    """
+    READAHEAD = 1 << 20
+
+    def __init__(self, url, session):
+        super().__init__()
+        self.name = url
+        self.session = session
+        with http_get_range(session, url, 0, 1) as response:
+            # Content-Range: bytes 0-0/<size>
+            self.size = int(response.headers["Content-Range"].rsplit("/", 1)[1])
+        self.position = 0
+        self.buffer = b''
+        self.buffer_start = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self.position = offset
+        return offset
+
+    def readinto(self, b):
+        length = min(len(b), self.size - self.position)
+        if length <= 0:
+            return 0
+        offset = self.position - self.buffer_start
+        if offset < 0 or offset + length > len(self.buffer):
+            self.buffer_start = self.position
+            fetch = min(max(length, self.READAHEAD), self.size - self.position)
+            self.buffer = http_get_range(self.session, self.name, self.position, fetch).content
+            offset = 0
+        b[:length] = self.buffer[offset:offset + length]
+        self.position += length
+        return length
+
+
+def coalesce_ranges(ranges, gap=FETCH_GAP, limit=FETCH_CHUNK):
+    """Merges sorted (start, length) byte ranges that are at most gap apart, into ranges of at most limit bytes."""
+    merged = []
+    for start, length in ranges:
+        if merged and start <= merged[-1][0] + merged[-1][1] + gap:
+            last_start, last_length = merged[-1]
+            merged[-1] = last_start, max(last_length, start + length - last_start)
+        else:
+            merged.append((start, length))
+    return [(start + offset, min(limit, length - offset))
+            for start, length in merged for offset in range(0, length, limit)]
+
+
+def fetch_range(session, url, fd, start, length):
+    with http_get_range(session, url, start, length, stream=True) as response:
+        for chunk in response.iter_content(COPY_CHUNK):
+            pwrite(fd, chunk, start)
+            start += len(chunk)
+            length -= len(chunk)
+    if length:
+        raise IOError(f"Short read from {url}, {length:d} bytes missing")
+
+
+class PayloadImage(io.RawIOBase):
+    """Read-only view of one partition image straight from a payload, usable as the stream of ext4.Volume.
+
+    Only the operations covering the blocks read are decoded, the most recent ones are kept up to cache_size bytes.
+    ZERO/DISCARD and SOURCE_COPY operations are never decoded, only the bytes read are taken from the old image.
+    """
+
+    def __init__(self, payloadfile, partition, member=None, old=None, cache_size=64 << 20, verify=False):
+        super().__init__()
+        if is_url(payloadfile):
+            raise ValueError("PayloadImage needs a local payload file")
+        self.dumper = Dumper(payloadfile, "", diff=old is not None, old=old, images=[partition], member=member,
+                             verify=verify)
+        partitions = self.dumper.select_partitions()
+        if not partitions:
+            raise KeyError(partition)
+        self.table = OperationTable(partitions[0], self.dumper.data_offset)
+        self.dumper.payloadfile.close()
+        self.dumper.dam = None
+        self.dumper.payload_fd = os.open(self.dumper.payloadpath, os.O_RDONLY | O_BINARY)
+        self.source = SourceImage(f"{old}/{partition}.img") if old is not None else None
+        self.name = partition
+        self.block_size = self.dumper.block_size
+        self.size = self.dumper.partition_size(self.table)
+        # (start_block, num_blocks, operation index, byte offset of the extent within the operation data)
+        extents = []
+        for index in range(len(self.table)):
+            position = 0
+            for start_block, num_blocks in self.table.dst(index):
+                extents.append((start_block, num_blocks, index, position))
+                position += num_blocks * self.block_size
+        extents.sort()
+        self.extents = extents
+        self.starts = [extent[0] for extent in extents]
+        self.cache_size = cache_size
+        self.cache_used = 0
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self.position = offset
+        return offset
+
+    def op_data(self, index):
+        with self.lock:
+            data = self.cache.get(index)
+            if data is not None:
+                self.cache.move_to_end(index)
+                return data
+        data = self.dumper.op_data(self.table, index, self.source)
+        if len(data) > self.cache_size:
+            return data
+        with self.lock:
+            previous = self.cache.pop(index, None)
+            if previous is not None:
+                self.cache_used -= len(previous)
+            self.cache[index] = data
+            self.cache_used += len(data)
+            while self.cache_used > self.cache_size:
+                self.cache_used -= len(self.cache.popitem(last=False)[1])
+        return data
+
+    def source_data(self, index, position, length):
+        """length bytes at position of a SOURCE_COPY operation's data, read from the old image alone."""
+        block_size = self.block_size
+        chunks = []
+        for start_block, num_blocks in self.table.src(index):
+            if length <= 0:
+                break
+            extent_size = num_blocks * block_size
+            if position < extent_size:
+                size = min(length, extent_size - position)
+                offset = start_block * block_size + position
+                chunks.append(self.source.map[offset:offset + size])
+                length -= size
+                position = 0
+            else:
+                position -= extent_size
+        return b''.join(chunks)
+
+    def pread(self, length, offset):
+        length = max(0, min(length, self.size - offset))
+        out = bytearray(length)
+        block_size = self.block_size
+        op = um.InstallOperation
+        i = max(0, bisect.bisect_right(self.starts, offset // block_size) - 1)
+        while i < len(self.extents):
+            start_block, num_blocks, index, position = self.extents[i]
+            start = max(offset, start_block * block_size)
+            end = min(offset + length, (start_block + num_blocks) * block_size)
+            if start_block * block_size >= offset + length:
+                break
+            if start < end:
+                op_type = self.table.types[index]
+                source = position + start - start_block * block_size
+                # Blocks outside every extent, and those of ZERO/DISCARD operations, stay zero
+                if op_type == op.SOURCE_COPY and self.source is not None:
+                    out[start - offset:end - offset] = self.source_data(index, source, end - start)
+                elif op_type not in (op.ZERO, op.DISCARD):
+                    data = self.op_data(index)
+                    out[start - offset:end - offset] = data[source:source + end - start]
+            i += 1
+        return bytes(out)
+
+    def readinto(self, b):
+        data = self.pread(len(b), self.position)
+        b[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def close(self):
+        if self.dumper.payload_fd is not None:
+            os.close(self.dumper.payload_fd)
+            self.dumper.payload_fd = None
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+        super().close()
+
+
+def inspect_cache_path(path, member=None):
+    if member:
+        return f"{path}.{member.replace('/', '_')}.info.json"
+    return f"{path}.info.json"
+
+
+def inspect_cache_key(path, member=None):
+    st = os.stat(path)
+    return [INSPECT_CACHE_VERSION, member, st.st_size, st.st_mtime_ns]
+
+
+def inspect_payload(payloadfile, member=None):
+    """Dumper.inspect() of a payload, served from the cache next to it while the payload is unchanged."""
+    if not is_url(payloadfile):
+        try:
+            with open(inspect_cache_path(payloadfile, member)) as f:
+                cache = json.load(f)
+            if cache["key"] == inspect_cache_key(payloadfile, member):
+                return cache["partitions"]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+    dumper = Dumper(payloadfile, "", member=member)
+    try:
+        return dumper.inspect()
+    finally:
+        dumper.payloadfile.close()
+
+
+def info(payloadfile, member=None):
+    partitions = inspect_payload(payloadfile, member)
+    for part in partitions:
+        types = ", ".join(f"{name}: {count}" for name, count in sorted(part["types"].items()))
+        print(f"{part['name']:<24} {part['size']:>14} bytes  {part['operations']:>7} ops  "
+              f"{part['data_bytes']:>14} data bytes  [{types}]")
+    return " ".join(part["name"] for part in partitions)
+
+
+def run(payloadfile, out, part, member=None):
+    return Dumper(payloadfile, out, images=[part], member=member).run()
+
+
+def main(payloadfile, out, member=None, on_partition_done=None, budget=None, cache=False):
+    # The image cache costs a read back and hash of every image (and its verity data), so it is opt-in here
+    return Dumper(payloadfile, out, member=member, on_partition_done=on_partition_done, budget=budget,
+                  cache=cache).run()
+
+
+def make_super(payloadfile, out, size=None, sparse=False, member=None):
+    # Dynamic partitions go straight into out/super.img, the others are dumped next to it as usual
+    return Dumper(payloadfile, out, member=member, sparse=sparse, super_image=os.path.join(out, "super.img"),
+                  super_size=size).run()
+
+
+# State of a process-pool worker, set up once by init_worker
+worker_dumper = None
+
+
+def init_worker(dumper):
+    global worker_dumper
+    dumper.payload_fd = os.open(dumper.payloadpath, os.O_RDONLY | O_BINARY)
+    dumper.part_fds = {}
+    worker_dumper = dumper
+
+
+def process_op(name, index):
+    fds = worker_dumper.part_fds.get(name)
+    if fds is None:
+        fds = worker_dumper.part_fds[name] = worker_dumper.open_part(name, truncate=False)
+    worker_dumper.data_for_op(worker_dumper.tables[name], index, *fds)
+
+
 class Dumper:
     def __init__(
-            self, payloadfile, out, diff=None, old=None, images="", workers=cpu_count(), buffsize=8192
+            self, payloadfile, out, diff=None, old=None, images="", workers=cpu_count(), buffsize=8192,
+            backend="thread", member=None, verify=False, sparse=False, on_partition_done=None, budget=None,
+            verity=False, cache=True, super_image=None, super_size=None
     ):
-        self.payloadpath = payloadfile
+        # buffsize is accepted for compatibility only, operations are no longer streamed through a buffer
+        if backend not in BACKENDS:
+            raise ValueError(f"backend must be one of {BACKENDS}, not {backend!r}")
+        # A list of payloads is a chain applied in order (a full OTA and its incrementals, say), only the images of
+        # the last payload are written
+        if isinstance(payloadfile, (list, tuple)):
+            *self.chain, payloadfile = payloadfile
+        else:
+            self.chain = []
+        # Source image paths that replace {old}/{name}.img, by partition name
+        self.sources = {}
+        # A payload (or OTA zip) URL is read with HTTP Range requests: the header and manifest directly, the data
+        # of the selected partitions is fetched into a local sparse copy at payloadpath before extraction
+        self.url = payloadfile if is_url(payloadfile) else None
+        self.session = None
+        if self.url:
+            self.session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=workers)
+            self.session.mount("http://", adapter)
+            self.session.mount("https://", adapter)
+            name = os.path.basename(urlparse(self.url).path) or "payload.bin"
+            self.payloadpath = os.path.join(out, name + ".download")
+        else:
+            self.payloadpath = payloadfile
         payloadfile = self.open_payloadfile()
+        # payload.bin may be read in place from an OTA zip, all offsets are then relative to the member data
+        self.member = member
+        self.payload_offset = zip_member_offset(payloadfile, member) if member else 0
         self.payloadfile = payloadfile
-        self.tls = threading.local()
+        self.payload_fd = None
         self.out = out
         self.diff = diff
         self.old = old
         self.images = images
         self.workers = workers
-        self.buffsize = buffsize
+        self.backend = backend
+        self.verify = verify
+        self.sparse = sparse
+        # Regenerate the dm-verity hash tree and FEC data the operations leave out, as update_engine does
+        self.verity = verity
+        # Size, mtime and SHA-256 of the images written to out, partitions whose image already matches the manifest
+        # hash are skipped
+        self.cache = cache
+        self.image_cache = {}
+        # Pipeline hooks: on_partition_done(image_path) is called as soon as a partition image is complete, and
+        # budget is a semaphore bounding the operations in flight, shared with whatever consumes the images
+        self.on_partition_done = on_partition_done
+        self.budget = budget
+        # Path of a super image to write the dynamic partitions into instead of one image each, and the size of the
+        # super device (by default the groups' maximum sizes plus the metadata)
+        self.super_image = super_image
+        self.super_size = super_size
+        # lpmake.SuperLayout of the super image, and its SparseLayout when it is written as a sparse image
+        self.super_layout = None
+        self.super_sparse = None
+        # Names of the partitions written into the super image, and those of them not done yet
+        self.super_partitions = set()
+        self.super_pending = set()
+        self.super_lock = threading.Lock()
+        # OperationTable of every selected partition, by partition name
+        self.tables = {}
+        # SparseLayout of every partition when writing Android sparse images, SuperSlice of every partition in the
+        # super image, by partition name
+        self.layouts = {}
+        self.errors = {}
         self.validate_magic()
 
+    def __getstate__(self):
+        # Shipped once to every process-pool worker, which opens its own descriptors.
+        # Generated protobuf classes do not pickle, the workers only need the operation tables.
+        state = self.__dict__.copy()
+        state["payloadfile"] = None
+        state["payload_fd"] = None
+        state["dam"] = None
+        state["session"] = None
+        state["on_partition_done"] = None
+        state["budget"] = None
+        state["super_lock"] = None
+        return state
+
     def open_payloadfile(self):
+        if self.url:
+            return HttpFile(self.url, self.session)
         return open(self.payloadpath, 'rb')
 
-    def run(self, slow=False) -> bool:
+    def download_ranges(self, tables):
+        # Only the data of the selected operations is fetched, the rest of the local copy stays a hole
+        ranges = sorted((table.data_offsets[index], table.data_lengths[index])
+                        for table in tables for index in range(len(table)) if table.data_lengths[index])
+        fd = os.open(self.payloadpath, os.O_RDWR | os.O_CREAT | os.O_TRUNC | O_BINARY, 0o644)
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = [executor.submit(fetch_range, self.session, self.url, fd, start, length)
+                           for start, length in coalesce_ranges(ranges)]
+                for future in as_completed(futures):
+                    future.result()
+        finally:
+            os.close(fd)
+
+    def load_manifest(self):
+        if self.dam is None:
+            # Released by an earlier run
+            self.payloadfile = self.open_payloadfile()
+            self.validate_magic()
+        return self.dam
+
+    def inspect(self):
+        """Summary of every partition in the manifest, the data section is never read.
+
+        The result is also written next to the payload, so inspect_payload() can answer without parsing the manifest.
+        """
+        partitions = []
+        for partition in self.load_manifest().partitions:
+            types = {}
+            for op in partition.operations:
+                name = um.InstallOperation.Type.Name(op.type)
+                types[name] = types.get(name, 0) + 1
+            partitions.append({
+                "name": partition.partition_name,
+                "size": partition.new_partition_info.size,
+                "operations": len(partition.operations),
+                "data_bytes": sum(op.data_length for op in partition.operations),
+                "types": types,
+            })
+        if self.url:
+            # Nothing local to sit next to
+            return partitions
+        key = inspect_cache_key(self.payloadpath, self.member)
+        try:
+            with open(inspect_cache_path(self.payloadpath, self.member), 'w') as f:
+                json.dump({"key": key, "partitions": partitions}, f)
+        except OSError:
+            # The payload may sit in a read-only location, the cache is only an optimization
+            pass
+        return partitions
+
+    def select_partitions(self):
         if self.images == "":
-            partitions = self.dam.partitions
-        else:
-            partitions = []
-            for image in self.images:
-                found = False
-                for dam_part in self.dam.partitions:
-                    if dam_part.partition_name == image:
-                        partitions.append(dam_part)
-                        found = True
-                        break
-                if not found:
-                    print(f"Partition {image} not found in image")
-
-        if len(partitions) == 0:
+            return list(self.dam.partitions)
+        partitions = []
+        for image in self.images:
+            found = False
+            for dam_part in self.dam.partitions:
+                if dam_part.partition_name == image:
+                    partitions.append(dam_part)
+                    found = True
+                    break
+            if not found:
+                print(f"Partition {image} not found in image")
+        return partitions
+
+    def run(self, slow=False) -> bool:
+        self.load_manifest()
+        tables = [OperationTable(partition, self.data_offset) for partition in self.select_partitions()]
+        dynamic_partitions = None
+        if self.super_image:
+            # A copy, the sub-message would keep the whole manifest alive
+            dynamic_partitions = um.DynamicPartitionMetadata()
+            dynamic_partitions.CopyFrom(self.dam.dynamic_partition_metadata)
+        # Everything below runs off the tables, the manifest can go
+        self.payloadfile.close()
+        self.dam = None
+
+        if len(tables) == 0:
             print("Not operating on any partitions")
             return False
 
+        if self.super_image:
+            self.layout_super(tables, dynamic_partitions)
+        if self.cache:
+            self.load_image_cache()
         partitions_with_ops = []
-        for partition in partitions:
-            operations = []
-            for operation in partition.operations:
-                self.payloadfile.seek(self.data_offset + operation.data_offset)
-                operations.append(
-                    {
-                        "data_offset": self.payloadfile.tell(),
-                        "operation": operation,
-                        "data_length": operation.data_length,
-                    }
-                )
-            partitions_with_ops.append(
-                {
-                    "partition": partition,
-                    "operations": operations,
-                }
-            )
+        for table in tables:
+            if self.sparse and table.name not in self.super_partitions:
+                extents = SparseLayout.table_extents(table, self.verity_extents(table))
+                self.layouts[table.name] = SparseLayout(extents, self.block_size, self.partition_size(table))
+            if self.cached(table.name) and self.image_unchanged(table):
+                print(f"{table.name} unchanged, skipped")
+                self.partition_done(table.name)
+                continue
+            self.tables[table.name] = table
+            partitions_with_ops.append({"table": table})
+        tables = [part["table"] for part in partitions_with_ops]
 
-        self.payloadfile.close()
-        if slow:
-            self.extract_slow(partitions_with_ops)
-        else:
-            self.multiprocess_partitions(partitions_with_ops)
-        return True
+        try:
+            # Inside the try, so a failed download does not leave the partial payload copy behind
+            if self.url:
+                self.download_ranges(tables)
+            if self.super_layout:
+                self.create_super()
+            if self.chain:
+                self.apply_chain(tables)
+            self.payload_fd = os.open(self.payloadpath, os.O_RDONLY | O_BINARY)
+            try:
+                if slow:
+                    self.extract_slow(partitions_with_ops)
+                else:
+                    self.multiprocess_ops(partitions_with_ops)
+            finally:
+                os.close(self.payload_fd)
+                self.payload_fd = None
+        finally:
+            if self.url and os.path.exists(self.payloadpath):
+                os.remove(self.payloadpath)
+            for slot in range(2):
+                shutil.rmtree(self.chain_dir(slot), ignore_errors=True)
+            if self.cache:
+                self.save_image_cache()
+        return not self.errors
+
+    def layout_super(self, tables, metadata):
+        """Lays the selected dynamic partitions out in the super image, as lpmake would from their images.
+
+        Every partition lands in slot a of its group, slot b is left empty. Virtual A/B payloads get the three
+        metadata slots and the header flag of lpmake --virtual-ab.
+        """
+        sizes = {table.name: self.partition_size(table) for table in tables}
+        partitions = []
+        groups = []
+        for group in metadata.groups:
+            groups += [(group.name + "_a", group.size), (group.name + "_b", group.size)]
+            for name in group.partition_names:
+                if name in sizes:
+                    partitions += [(name + "_a", group.name + "_a", sizes[name]), (name + "_b", group.name + "_b", 0)]
+        if not partitions:
+            raise ValueError("None of the selected partitions is in the payload's dynamic_partition_metadata")
+        virtual_ab = metadata.snapshot_enabled
+        layout_args = dict(metadata_slots=3 if virtual_ab else 2, block_size=self.block_size, virtual_ab=virtual_ab)
+        layout = lpmake.SuperLayout(partitions, groups, self.super_size, **layout_args)
+        if not self.super_size:
+            # A device's super partition holds its groups at their maximum size, both slots of them without Virtual A/B
+            reserved = sum(group.size for group in metadata.groups) * (1 if virtual_ab else 2)
+            size = lpmake.align_to(layout.first_logical_sector * lpmake.LP_SECTOR_SIZE + reserved, layout.alignment)
+            if size > layout.device_size:
+                layout = lpmake.SuperLayout(partitions, groups, size, **layout_args)
+        self.super_layout = layout
+        offsets = {name[:-2]: offset for name, offset in layout.offsets().items()}
+        sparse = None
+        if self.sparse:
+            # One sparse image over the whole device: the metadata, then every partition's chunks at its offset
+            extents = [(0, -(-layout.metadata_end // self.block_size), CHUNK_TYPE_RAW)]
+            for table in tables:
+                if table.name in offsets:
+                    start = offsets[table.name] // self.block_size
+                    extents += [(start + start_block, num_blocks, chunk_type) for start_block, num_blocks, chunk_type
+                                in SparseLayout.table_extents(table, self.verity_extents(table))]
+            sparse = SparseLayout(extents, self.block_size, layout.device_size)
+        self.super_sparse = sparse
+        for name, offset in offsets.items():
+            self.layouts[name] = SuperSlice(offset, sparse)
+        self.super_partitions = set(offsets)
+        self.super_pending = set(offsets)
+
+    def create_super(self):
+        # Interrupted super images are not resumed, every run starts from a new sparse file
+        fd = os.open(self.super_image, os.O_RDWR | os.O_CREAT | os.O_TRUNC | O_BINARY, 0o644)
+        try:
+            sparse = self.super_sparse
+            if sparse:
+                sparse.write_headers(fd)
+            os.ftruncate(fd, sparse.file_size if sparse else self.super_layout.device_size)
+            layout = SuperSlice(0, sparse)
+            for offset, data in self.super_layout.regions():
+                for _, file_offset, size in layout.map(offset, len(data)):
+                    pwrite(fd, data[:size], file_offset)
+                    data = data[size:]
+        finally:
+            os.close(fd)
+
+    def cached(self, name):
+        # Partitions inside the super image have no image of their own to cache
+        return self.cache and name not in self.super_partitions
+
+    def image_cache_path(self):
+        return os.path.join(self.out, ".dumper_cache.json")
+
+    def load_image_cache(self):
+        try:
+            with open(self.image_cache_path()) as f:
+                self.image_cache = json.load(f)
+        except (OSError, ValueError):
+            self.image_cache = {}
+
+    def save_image_cache(self):
+        try:
+            with open(self.image_cache_path(), 'w') as f:
+                json.dump(self.image_cache, f)
+        except OSError:
+            pass
+
+    def record_image(self, name, digest):
+        stat = os.stat(f"{self.out}/{name}.img")
+        self.image_cache[name] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sparse": bool(self.sparse),
+                                  "sha256": digest.hex()}
+
+    def image_unchanged(self, table):
+        image = f"{self.out}/{table.name}.img"
+        entry = self.image_cache.get(table.name)
+        if not table.hash or not entry or entry["sparse"] != bool(self.sparse) or not os.path.isfile(image) \
+                or os.path.isfile(image + ".journal"):
+            return False
+        stat = os.stat(image)
+        if (stat.st_size, stat.st_mtime_ns) == (entry["size"], entry["mtime_ns"]):
+            return entry["sha256"] == table.hash.hex()
+        # Touched since it was recorded, only its content counts
+        layout = self.layouts.get(table.name)
+        fd = os.open(image, os.O_RDONLY | O_BINARY)
+        try:
+            if layout and not layout.matches(fd):
+                return False
+            digest = PartitionHasher(fd, table.size, self.block_size, layout).digest()
+        finally:
+            os.close(fd)
+        self.record_image(table.name, digest)
+        return digest == table.hash
+
+    def chain_dir(self, slot):
+        return os.path.join(self.out, f".chain{slot:d}")
+
+    def apply_chain(self, tables):
+        """Applies the earlier payloads of the chain into intermediate images, which the last payload reads from.
+
+        Working back from the last payload, a stage only runs the operations writing blocks that the next stage
+        reads. Each partition alternates between two intermediate images, read back memory-mapped as the source of
+        the next stage.
+        """
+        stages = []
+        for index, path in enumerate(self.chain):
+            stage = Dumper(path, self.out, diff=self.diff, old=self.old, workers=self.workers, verify=self.verify)
+            partitions = {partition.partition_name: partition for partition in stage.dam.partitions}
+            stage.tables = {table.name: OperationTable(partitions[table.name], stage.data_offset)
+                            for table in tables if table.name in partitions}
+            stage.payloadfile.close()
+            stage.dam = None
+            stages.append(stage)
+
+        for table in tables:
+            # Operation indices of every stage, None for stages without the partition
+            selected = []
+            needed = source_blocks(table, range(len(table)))
+            for stage in reversed(stages):
+                stage_table = stage.tables.get(table.name)
+                if stage_table is None:
+                    selected.append(None)
+                    continue
+                indices = [index for index in range(len(stage_table))
+                           if any(needed.find(1, start_block, start_block + num_blocks) != -1
+                                  for start_block, num_blocks in stage_table.dst(index))]
+                selected.append(indices)
+                needed = source_blocks(stage_table, indices)
+            selected.reverse()
+
+            current = None
+            slot = 1
+            for stage, indices in zip(stages, selected):
+                # Stages without the partition, or without an operation the next stage reads from, write nothing
+                if not indices:
+                    continue
+                slot ^= 1
+                os.makedirs(self.chain_dir(slot), exist_ok=True)
+                path = os.path.join(self.chain_dir(slot), f"{table.name}.img")
+                stage.sources = {table.name: current} if current else {}
+                stage.run_ops(stage.tables[table.name], indices, path)
+                current = path
+            if current:
+                self.sources[table.name] = current
+
+    def run_ops(self, table, indices, path):
+        # One stage of a chain, written to a scratch image with the thread backend
+        self.payload_fd = os.open(self.payloadpath, os.O_RDONLY | O_BINARY)
+        out_fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | O_BINARY, 0o644)
+        source = self.source_image(table.name) if self.has_source(table.name) else None
+        try:
+            os.ftruncate(out_fd, self.partition_size(table))
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = [executor.submit(self.data_for_op, table, index, out_fd, source) for index in indices]
+                for future in as_completed(futures):
+                    future.result()
+        finally:
+            os.close(out_fd)
+            os.close(self.payload_fd)
+            self.payload_fd = None
+            if source is not None:
+                source.close()
 
     def extract_slow(self, partitions):
         for part in partitions:
-            self.dump_part(part)
+            partition_name = part["table"].name
+            try:
+                if self.budget:
+                    with self.budget:
+                        self.dump_part(part)
+                else:
+                    self.dump_part(part)
+                self.partition_done(partition_name)
+            except Exception as exc:
+                # A failed partition is reported like in the pooled modes, the others are still extracted
+                self.part_failed(partition_name, exc)
 
-    def multiprocess_partitions(self, partitions):
-        with ThreadPoolExecutor(max_workers=self.workers) as executor:
-            futures = {executor.submit(self.dump_part, part): part for part in partitions}
-            for future in as_completed(futures):
-                partition_name = futures[future]['partition'].partition_name
+    def partition_done(self, name):
+        path = f"{self.out}/{name}.img"
+        if name in self.super_partitions:
+            # The super image is done with its last partition
+            with self.super_lock:
+                self.super_pending.discard(name)
+                if self.super_pending:
+                    return
+            path = self.super_image
+        if self.on_partition_done:
+            self.on_partition_done(path)
+
+    def multiprocess_ops(self, partitions):
+        jobs = []
+        for part in partitions:
+            table = part["table"]
+            part["journal"] = self.open_journal(table)
+            part["out_fd"], part["source"], part["layout"] = self.open_part(
+                table.name, truncate=not part["journal"].done, size=self.partition_size(table))
+            part["journal"].start(part["out_fd"])
+            indices = [index for index in range(len(table)) if index not in part["journal"].done]
+            part["pending"] = len(indices)
+            part["error"] = None
+            part["hasher"] = self.part_hasher(table, part["out_fd"], part["layout"])
+            if not part["pending"]:
+                self.finish_part(part)
+            jobs.extend((table.dst_blocks(index), part, index) for index in indices)
+        # Largest jobs first (popped from the end), so the workers end up balancing on the small ones
+        jobs.sort(key=lambda job: job[0])
+        if self.backend == "process":
+            executor = ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker, initargs=(self,))
+        else:
+            executor = ThreadPoolExecutor(max_workers=self.workers)
+        # Partition hashing reads back finished extents while the decompression still goes on
+        hash_executor = ThreadPoolExecutor(max_workers=self.workers) if any(part["hasher"] for part in partitions) \
+            else None
+        # (part, future) of everything run on the hash executor, checked once it is done
+        hash_futures = []
+        with executor:
+            futures = {}
+            done = queue.SimpleQueue()
+            while jobs or futures:
+                # Without a budget everything is queued at once, with one the operations in flight hold a slot
+                # each and completed partitions can be consumed in between
+                while jobs and (self.budget is None or self.budget.acquire(blocking=not futures)):
+                    _, part, index = jobs.pop()
+                    if self.backend == "process":
+                        future = executor.submit(process_op, part["table"].name, index)
+                    else:
+                        future = executor.submit(self.data_for_op, part["table"], index, part["out_fd"],
+                                                 part["source"], part["layout"])
+                    futures[future] = part, index
+                    future.add_done_callback(done.put)
+                future = done.get()
+                if self.budget:
+                    self.budget.release()
+                part, index = futures.pop(future)
                 try:
                     future.result()
-                    print(f"{partition_name} Done!")
+                    part["journal"].record(index)
                 except Exception as exc:
-                    print(f"{partition_name} - processing generated an exception: {exc}")
+                    part["error"] = part["error"] or exc
+                part["pending"] -= 1
+                if part["hasher"]:
+                    hash_futures.append((part, hash_executor.submit(part["hasher"].update, part["table"].dst(index))))
+                if not part["pending"]:
+                    if hash_executor:
+                        hash_futures.append((part, hash_executor.submit(self.finish_part, part)))
+                    else:
+                        try:
+                            self.finish_part(part)
+                        except Exception as exc:
+                            self.part_failed(part["table"].name, exc)
+        if hash_executor:
+            hash_executor.shutdown()
+            for part, future in hash_futures:
+                try:
+                    future.result()
+                except Exception as exc:
+                    self.part_failed(part["table"].name, exc)
+
+    def open_part(self, name, truncate=True, size=0):
+        if name in self.super_partitions:
+            # Written in place, create_super() already laid out the whole file
+            out_fd = os.open(self.super_image, os.O_RDWR | O_BINARY)
+            truncate = False
+        else:
+            flags = os.O_RDWR | os.O_CREAT | O_BINARY
+            if truncate:
+                flags |= os.O_TRUNC
+            out_fd = os.open(f"{self.out}/{name}.img", flags, 0o644)
+        layout = self.layouts.get(name)
+        if truncate:
+            # Sized up front as one sparse file, ZERO/DISCARD extents and zero blocks then stay holes
+            if layout:
+                layout.write_headers(out_fd)
+                size = layout.file_size
+            os.ftruncate(out_fd, size)
+        if self.has_source(name):
+            source = self.source_image(name)
+        else:
+            source = None
+        return out_fd, source, layout
+
+    def has_source(self, name):
+        # Partitions new in the last payload of a chain have no source, unless old images were asked for
+        return self.diff or name in self.sources
+
+    def source_image(self, name):
+        return SourceImage(self.sources.get(name, f"{self.old}/{name}.img"))
+
+    def partition_size(self, table):
+        return table.size or table.dst_end * self.block_size
+
+    def open_journal(self, table):
+        if table.name in self.super_partitions:
+            return OperationJournal(f"{self.super_image}.{table.name}.journal", table, resume=False,
+                                    sparse=self.sparse)
+        image = f"{self.out}/{table.name}.img"
+        return OperationJournal(image + ".journal", table, resume=os.path.isfile(image), sparse=self.sparse)
+
+    def part_hasher(self, table, out_fd, layout=None):
+        # The image cache records the hash even when it is not verified
+        if not (self.verify or self.cached(table.name)) or not table.hash:
+            return None
+        return PartitionHasher(out_fd, table.size, self.block_size, layout)
+
+    def writes_verity(self, table):
+        # The manifest hash covers the verity data the operations leave out, an image that is verified or recorded in
+        # the image cache needs it rebuilt
+        if not (table.hash_tree_extent or table.fec_extent):
+            return False
+        return self.verity or (bool(table.hash) and (self.verify or self.cached(table.name)))
+
+    def verity_extents(self, table):
+        if not self.writes_verity(table):
+            return []
+        return [extent for extent in (table.hash_tree_extent, table.fec_extent) if extent]
+
+    def write_verity(self, table, out_fd, layout=None):
+        # The hash tree goes first, the FEC data also covers it
+        block_size = self.block_size
+        read = partial(layout.pread, out_fd) if layout else partial(pread, out_fd)
+        if table.hash_tree_extent and table.hash_tree_data_extent:
+            start_block, num_blocks = table.hash_tree_data_extent
+            offset = start_block * block_size
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                tree = verity.build_hash_tree(lambda length, position: read(length, offset + position),
+                                              num_blocks * block_size, block_size, table.hash_tree_algorithm,
+                                              table.hash_tree_salt, executor)
+            ExtentWriter(out_fd, [table.hash_tree_extent], block_size, layout).write(tree)
+        if table.fec_extent and table.fec_data_extent and table.fec_roots:
+            start_block, num_blocks = table.fec_data_extent
+            offset = start_block * block_size
+            out_file = ExtentWriter(out_fd, [table.fec_extent], block_size, layout)
+            for data in verity.build_fec(lambda length, position: read(length, offset + position),
+                                         num_blocks * block_size, block_size, table.fec_roots):
+                out_file.write(data)
+
+    def check_part_hash(self, table, hasher):
+        digest = hasher.digest()
+        if self.verify and digest != table.hash:
+            raise VerificationError("partition hash mismatch")
+        return digest
+
+    def finish_part(self, part):
+        # Only failed operations are worth resuming, a bad partition hash restarts from scratch
+        part["journal"].close(completed=not part["error"])
+        if self.writes_verity(part["table"]) and not part["error"]:
+            try:
+                self.write_verity(part["table"], part["out_fd"], part["layout"])
+            except Exception as exc:
+                part["error"] = exc
+        digest = None
+        if part["hasher"] and not part["error"]:
+            try:
+                digest = self.check_part_hash(part["table"], part["hasher"])
+            except VerificationError as exc:
+                part["error"] = exc
+        os.close(part["out_fd"])
+        if part["source"] is not None:
+            part["source"].close()
+        partition_name = part["table"].name
+        if digest and self.cached(partition_name):
+            self.record_image(partition_name, digest)
+        if part["error"]:
+            self.part_failed(partition_name, part["error"])
+        else:
+            print(f"{partition_name} Done!")
+            self.partition_done(partition_name)
+
+    def part_failed(self, name, exc):
+        # The first failure of a partition is the one kept
+        self.errors.setdefault(name, exc)
+        print(f"{name} - processing generated an exception: {exc}")
 
     def validate_magic(self):
+        self.payloadfile.seek(self.payload_offset)
         magic = self.payloadfile.read(4)
         assert magic == b"CrAU"
         file_format_version = u64(self.payloadfile.read(8))
@@ -117,99 +1504,96 @@ class Dumper:
         self.dam.ParseFromString(manifest)
         self.block_size = self.dam.block_size
 
-    def data_for_op(self, operation, out_file, old_file):
-        payloadfile = self.tls.payloadfile
-        payloadfile.seek(operation["data_offset"])
-        buffsize = self.buffsize
-        processed_len = 0
-        data_length = operation["data_length"]
-        op = operation["operation"]
-
-        # assert hashlib.sha256(data).digest() == op.data_sha256_hash, 'operation data hash mismatch'
-
-        if op.type == op.REPLACE_XZ:
-            dec = lzma.LZMADecompressor()
-            out_file.seek(op.dst_extents[0].start_block * self.block_size)
-            while processed_len < data_length:
-                data = payloadfile.read(buffsize)
-                processed_len += len(data)
-                while True:
-                    data = dec.decompress(data, max_length=buffsize)
-                    out_file.write(data)
-                    if dec.needs_input or dec.eof:
-                        break
-                    data = b''
-        elif op.type == op.REPLACE_BZ:
-            dec = bz2.BZ2Decompressor()
-            out_file.seek(op.dst_extents[0].start_block * self.block_size)
-            while processed_len < data_length:
-                data = payloadfile.read(buffsize)
-                processed_len += len(data)
-                while True:
-                    data = dec.decompress(data, max_length=buffsize)
-                    out_file.write(data)
-                    if dec.needs_input or dec.eof:
-                        break
-                    data = b''
-        elif op.type == op.REPLACE:
-            out_file.seek(op.dst_extents[0].start_block * self.block_size)
-            dec = zstandard.ZstdDecompressor().decompressobj()
-            if payloadfile.read(4) == b'\x28\xb5\x2f\xfd':
-                payloadfile.seek(payloadfile.tell() - 4)
-                while processed_len < data_length:
-                    data = payloadfile.read(buffsize)
-                    processed_len += len(data)
-                    data = dec.decompress(data)
-                    out_file.write(data)
-                out_file.write(dec.flush())
-            else:
-                payloadfile.seek(payloadfile.tell() - 4)
-                while processed_len < data_length:
-                    data = payloadfile.read(buffsize)
-                    processed_len += len(data)
-                    out_file.write(data)
-
-        elif op.type == op.SOURCE_COPY:
-            if not self.diff:
-                print("SOURCE_COPY supported only for differential OTA")
-                sys.exit(-2)
-            out_file.seek(op.dst_extents[0].start_block * self.block_size)
-            for ext in op.src_extents:
-                old_file.seek(ext.start_block * self.block_size)
-                data_length = ext.num_blocks * self.block_size
-                while processed_len < data_length:
-                    data = old_file.read(buffsize)
-                    processed_len += len(data)
-                    out_file.write(data)
-                processed_len = 0
-        elif op.type == op.ZERO:
-            for ext in op.dst_extents:
-                out_file.seek(ext.start_block * self.block_size)
-                data_length = ext.num_blocks * self.block_size
-                while processed_len < data_length:
-                    data = bytes(min(data_length - processed_len, buffsize))
-                    out_file.write(data)
-                    processed_len += len(data)
-                processed_len = 0
+    def data_for_op(self, table, index, out_fd, source, layout=None):
+        payload_fd = self.payload_fd
+        offset = table.data_offsets[index]
+        op_type = table.types[index]
+        op = um.InstallOperation
+        out_file = ExtentWriter(out_fd, table.dst(index), self.block_size, layout)
+
+        if op_type == op.REPLACE and not (self.verify and table.data_hash(index)) and \
+                pread(payload_fd, 4, offset) != ZSTD_MAGIC:
+            # Uncompressed data is copied from the payload to the image by the kernel
+            out_file.copy(payload_fd, offset, table.data_lengths[index])
+        elif op_type == op.SOURCE_COPY and source is not None:
+            for start_block, num_blocks in table.src(index):
+                out_file.copy(source.fd, start_block * self.block_size, num_blocks * self.block_size)
+        elif op_type in (op.ZERO, op.DISCARD):
+            # Already holes in the preallocated output
+            pass
         else:
-            print(f"Unsupported type = {op.type:d}")
-            sys.exit(-1)
-        del data
+            out_file.write(self.op_data(table, index, source))
 
-    def dump_part(self, part):
-        name = part["partition"].partition_name
-        out_file = open(f"{self.out}/{name}.img", "wb")
+    def op_data(self, table, index, source):
+        """Decoded data of an operation, all of its dst_extents back to back."""
+        payload_fd = self.payload_fd
+        offset = table.data_offsets[index]
+        data_length = table.data_lengths[index]
+        op_type = table.types[index]
+        op = um.InstallOperation
 
-        if self.diff:
-            old_file = open(f"{self.old}/{name}.img", "rb")
+        if op_type in (op.REPLACE_XZ, op.REPLACE_BZ, op.REPLACE):
+            # Decode the whole operation in one call, the decompressors release the GIL while doing so
+            data = pread(payload_fd, data_length, offset)
+            self.check_op_hash(index, data, table.data_hash(index))
+            if op_type == op.REPLACE_XZ:
+                data = lzma.decompress(data)
+            elif op_type == op.REPLACE_BZ:
+                data = bz2.decompress(data)
+            elif data[:4] == ZSTD_MAGIC:
+                dst_size = table.dst_blocks(index) * self.block_size
+                data = zstandard.ZstdDecompressor().decompress(data, max_output_size=dst_size)
+            return data
+        elif op_type in (op.SOURCE_COPY, op.SOURCE_BSDIFF, op.BROTLI_BSDIFF):
+            if source is None:
+                raise ValueError(f"{op.Type.Name(op_type)} supported only for differential OTA")
+            old = source.read_extents(table.src(index), self.block_size)
+            if op_type == op.SOURCE_COPY:
+                return old
+            patch = pread(payload_fd, data_length, offset)
+            self.check_op_hash(index, patch, table.data_hash(index))
+            self.check_op_hash(index, old, table.src_hash(index), "source")
+            return bspatch(old, patch)
+        elif op_type in (op.ZERO, op.DISCARD):
+            return bytes(table.dst_blocks(index) * self.block_size)
         else:
-            old_file = None
+            # Raised rather than exiting, so the partition fails on its own (PUFFDIFF is common in incrementals)
+            name = op.Type.Name(op_type) if op_type in op.Type.values() else op_type
+            raise ValueError(f"Unsupported operation {name}")
+
+    def check_op_hash(self, index, data, expected, what="data"):
+        if self.verify and expected and hashlib.sha256(data).digest() != expected:
+            raise VerificationError(f"operation {index} {what} hash mismatch")
 
-        with self.open_payloadfile() as payloadfile:
-            self.tls.payloadfile = payloadfile
-            self.do_ops_for_part(part, out_file, old_file)
-        out_file.close()
+    def dump_part(self, part):
+        table = part["table"]
+        journal = self.open_journal(table)
+        out_fd, source, layout = self.open_part(table.name, truncate=not journal.done,
+                                                size=self.partition_size(table))
+        journal.start(out_fd)
+        try:
+            try:
+                self.do_ops_for_part(part, out_fd, source, layout, journal)
+            except BaseException:
+                journal.close(completed=False)
+                raise
+            journal.close(completed=True)
+            if self.writes_verity(table):
+                self.write_verity(table, out_fd, layout)
+            hasher = self.part_hasher(table, out_fd, layout)
+            digest = self.check_part_hash(table, hasher) if hasher else None
+        finally:
+            os.close(out_fd)
+            if source is not None:
+                source.close()
+        if digest and self.cached(table.name):
+            self.record_image(table.name, digest)
 
-    def do_ops_for_part(self, part, out_file, old_file):
-        for op in part["operations"]:
-            self.data_for_op(op, out_file, old_file)
+    def do_ops_for_part(self, part, out_fd, source, layout=None, journal=None):
+        table = part["table"]
+        for index in range(len(table)):
+            if journal and index in journal.done:
+                continue
+            self.data_for_op(table, index, out_fd, source, layout)
+            if journal:
+                journal.record(index)
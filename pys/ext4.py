@@ -1,8 +1,17 @@
+import bisect
 import ctypes
+from collections import OrderedDict
 from functools import cmp_to_key
 import io
 from math import log as log_math
+import mmap
+import os
 import queue
+import threading
+
+
+# Default chunk size of BlockReader.iter_chunks
+CHUNK_SIZE = 1 << 20
 
 
 def wcs_cmp(str_a, str_b):
@@ -213,6 +222,12 @@ class ext4_inode(ext4_struct):
         ("i_projid", ctypes.c_uint),  # 0x009C
     ]
 
+    @staticmethod
+    def _from_buffer_copy(raw, platform64=True):
+        # Inodes may be smaller than the structure (128-byte inodes have no extra fields), the rest reads as zeros
+        size = ctypes.sizeof(ext4_inode)
+        return ext4_inode.from_buffer_copy(bytes(raw[:size]).ljust(size, b"\0"))
+
 
 class ext4_superblock(ext4_struct):
     EXT2_DESC_SIZE = 0x20  # Default value for s_desc_size, if INCOMPAT_64BIT is not set (NEEDS CONFIRMATION)
@@ -390,7 +405,7 @@ class ext4_xattr_entry(ext4_struct):
     @staticmethod
     def _from_buffer_copy(raw, offset=0, platform64=True):
         struct = ext4_xattr_entry.from_buffer_copy(raw, offset)
-        struct.e_name = raw[offset + 0x10: offset + 0x10 + struct.e_name_len]
+        struct.e_name = bytes(raw[offset + 0x10: offset + 0x10 + struct.e_name_len])
         return struct
 
     @property
@@ -473,14 +488,43 @@ class MappingEntry:
 
 class Volume:
     ROOT_INODE = 2
+    # Inode tables of this many groups, and this many parsed inodes, are kept in memory
+    INODE_TABLE_CACHE_SIZE = 16
+    INODE_CACHE_SIZE = 8192
+    # Parsed xattr blocks kept in memory, Android images share a few of them between most inodes
+    XATTR_BLOCK_CACHE_SIZE = 1024
 
-    def __init__(self, stream, offset=0, ignore_flags=False, ignore_magic=False):
+    def __init__(self, stream, offset=0, ignore_flags=False, ignore_magic=False, use_mmap=False):
         self.ignore_flags = ignore_flags
         self.ignore_magic = ignore_magic
         self.offset = offset
         self.platform64 = True  # Initial value needed for Volume.read_struct
         self.stream = stream
 
+        # With use_mmap, a real file is mapped once and read as memoryview slices of the mapping. The mapping is
+        # copy-on-write so structures can sit on it with from_buffer, nothing is ever written back to the file.
+        self.mapping = None
+        self.view = None
+        if use_mmap:
+            try:
+                self.mapping = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_COPY)
+            except (AttributeError, io.UnsupportedOperation, OSError, ValueError):
+                # Not a file on disk, or an empty one: read through the stream
+                pass
+            else:
+                self.view = memoryview(self.mapping)
+
+        # Without a mapping, files are read with positional reads that leave the stream position alone, so the
+        # volume can be read from several threads. Other streams share their position and are read under a lock.
+        self.fileno = None
+        if self.view is None and hasattr(os, "pread"):
+            try:
+                self.fileno = stream.fileno()
+            except (AttributeError, io.UnsupportedOperation, OSError):
+                pass
+        self.stream_lock = threading.Lock()
+        self.cache_lock = threading.Lock()
+
         # Superblock
         self.superblock = self.read_struct(ext4_superblock, 0x400)
         self.platform64 = (self.superblock.s_feature_incompat & ext4_superblock.INCOMPAT_64BIT) != 0
@@ -488,13 +532,49 @@ class Volume:
         if not ignore_magic and self.superblock.s_magic != 0xEF53:
             raise MagicError(f"Invalid magic value in superblock: 0x{self.superblock.s_magic:04X} (expected 0xEF53)")
 
-        # Group descriptors
-        self.group_descriptors = [None] * (self.superblock.s_inodes_count // self.superblock.s_inodes_per_group)
+        # Group descriptors, read in one go
+        group_count = self.superblock.s_inodes_count // self.superblock.s_inodes_per_group
+        desc_size = self.superblock.s_desc_size
+        struct_size = ctypes.sizeof(ext4_group_descriptor)
 
         group_desc_table_offset = (0x400 // self.block_size + 1) * self.block_size  # First block after superblock
-        for group_desc_idx in range(len(self.group_descriptors)):
-            group_desc_offset = group_desc_table_offset + group_desc_idx * self.superblock.s_desc_size
-            self.group_descriptors[group_desc_idx] = self.read_struct(ext4_group_descriptor, group_desc_offset)
+        raw = self.read(group_desc_table_offset, max(0, group_count - 1) * desc_size + struct_size)
+        self.group_descriptors = [
+            ext4_group_descriptor._from_buffer_copy(raw[group_desc_idx * desc_size:group_desc_idx * desc_size + struct_size],
+                                                    platform64=self.platform64)
+            for group_desc_idx in range(group_count)
+        ]
+
+        # Whole inode tables by group index and (offset, raw inode, ext4_inode) by inode index, least recently used first
+        self.inode_tables = OrderedDict()
+        self.inodes = OrderedDict()
+        # Parsed (name, value) pairs of xattr blocks by block number, least recently used first, and one instance of
+        # every xattr value seen
+        self.xattr_blocks = OrderedDict()
+        self.xattr_values = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """Drops the caches and unmaps the file, the stream itself is left to its owner."""
+        self.inode_tables.clear()
+        self.inodes.clear()
+        self.xattr_blocks.clear()
+        self.xattr_values.clear()
+
+        if self.mapping is not None:
+            self.view.release()
+            self.view = None
+            try:
+                self.mapping.close()
+            except BufferError:
+                # Slices still held elsewhere keep the mapping alive until they are collected
+                pass
+            self.mapping = None
 
     def __repr__(self):
         return f"{type(self).__name__:s}(volume_name = {self.superblock.s_volume_name!r:s}, uuid = {self.uuid!r:s}, last_mounted = {self.superblock.s_last_mounted!r:s})"
@@ -533,14 +613,53 @@ class Volume:
         return data
 
     def get_inode(self, inode_idx, file_type=InodeType.UNKNOWN):
+        with self.cache_lock:
+            cached = self.inodes.get(inode_idx)
+            if cached is not None:
+                self.inodes.move_to_end(inode_idx)
+
+        if cached is None:
+            # Loaded outside the lock, a concurrent load of the same inode only costs a second parse
+            cached = self.load_inode(inode_idx)
+            with self.cache_lock:
+                self.inodes[inode_idx] = cached
+                if len(self.inodes) > self.INODE_CACHE_SIZE:
+                    self.inodes.popitem(last=False)
+
+        inode_offset, raw, inode = cached
+        return Inode(self, inode_offset, inode_idx, file_type, raw=raw, inode=inode)
+
+    def load_inode(self, inode_idx):
         group_idx, inode_table_entry_idx = self.get_inode_group(inode_idx)
+        inode_size = self.superblock.s_inode_size
         try:
             inode_table_offset = self.group_descriptors[group_idx].bg_inode_table * self.block_size
         except Exception:
             inode_table_offset = 99 * self.block_size
-        inode_offset = inode_table_offset + inode_table_entry_idx * self.superblock.s_inode_size
+            raw = self.read(inode_table_offset + inode_table_entry_idx * inode_size, inode_size)
+        else:
+            inode_table = self.get_inode_table(group_idx, inode_table_offset)
+            raw = inode_table[inode_table_entry_idx * inode_size:(inode_table_entry_idx + 1) * inode_size]
+        inode_offset = inode_table_offset + inode_table_entry_idx * inode_size
+
+        return inode_offset, raw, self.parse_inode(raw)
+
+    def get_inode_table(self, group_idx, inode_table_offset):
+        # The whole table is read the first time one of its inodes is needed
+        with self.cache_lock:
+            inode_table = self.inode_tables.get(group_idx)
+            if inode_table is not None:
+                self.inode_tables.move_to_end(group_idx)
 
-        return Inode(self, inode_offset, inode_idx, file_type)
+        if inode_table is None:
+            inode_table = self.read(inode_table_offset,
+                                    self.superblock.s_inodes_per_group * self.superblock.s_inode_size)
+            with self.cache_lock:
+                self.inode_tables[group_idx] = inode_table
+                if len(self.inode_tables) > self.INODE_TABLE_CACHE_SIZE:
+                    self.inode_tables.popitem(last=False)
+
+        return inode_table
 
     def get_inode_group(self, inode_idx):
         group_idx = (inode_idx - 1) // self.superblock.s_inodes_per_group
@@ -548,10 +667,46 @@ class Volume:
         return group_idx, inode_table_entry_idx
 
     def read(self, offset, byte_len):
-        if self.offset + offset != self.stream.tell():
-            self.stream.seek(self.offset + offset, io.SEEK_SET)
-
-        return self.stream.read(byte_len)
+        if self.view is not None:
+            return self.view[self.offset + offset:self.offset + offset + byte_len]
+
+        if self.fileno is not None:
+            data = os.pread(self.fileno, byte_len, self.offset + offset)
+            if 0 < len(data) < byte_len:
+                # A single pread may stop short of a large length, the rest is read until the end of the file
+                chunks = [data]
+                remaining = byte_len - len(data)
+                while remaining and data:
+                    data = os.pread(self.fileno, remaining, self.offset + offset + byte_len - remaining)
+                    chunks.append(data)
+                    remaining -= len(data)
+                data = b"".join(chunks)
+            return data
+
+        with self.stream_lock:
+            if self.offset + offset != self.stream.tell():
+                self.stream.seek(self.offset + offset, io.SEEK_SET)
+
+            return self.stream.read(byte_len)
+
+    def readinto(self, offset, buffer):
+        if self.view is not None:
+            data = self.view[self.offset + offset:self.offset + offset + len(buffer)]
+            buffer[:len(data)] = data
+            return len(data)
+
+        if self.fileno is not None:
+            if hasattr(os, "preadv"):
+                return os.preadv(self.fileno, [buffer], self.offset + offset)
+            data = os.pread(self.fileno, len(buffer), self.offset + offset)
+            buffer[:len(data)] = data
+            return len(data)
+
+        with self.stream_lock:
+            if self.offset + offset != self.stream.tell():
+                self.stream.seek(self.offset + offset, io.SEEK_SET)
+
+            return self.stream.readinto(buffer)
 
     def read_struct(self, structure, offset, platform64=None):
         raw = self.read(offset, ctypes.sizeof(structure))
@@ -559,7 +714,23 @@ class Volume:
         if hasattr(structure, "_from_buffer_copy"):
             return structure._from_buffer_copy(raw, platform64=platform64 if platform64 else self.platform64)
         else:
-            return structure.from_buffer_copy(raw)
+            return self.from_buffer(structure, raw)
+
+    @staticmethod
+    def from_buffer(structure, raw, offset=0):
+        """structure at offset of raw, sharing its memory when raw is a slice of the mapping.
+
+        Only for structures that are never written to, those with a _from_buffer_copy fix up fields and keep copying.
+        """
+        if isinstance(raw, memoryview) and not raw.readonly and len(raw) - offset >= ctypes.sizeof(structure):
+            return structure.from_buffer(raw, offset)
+        return structure.from_buffer_copy(raw, offset)
+
+    def parse_inode(self, raw):
+        if len(raw) < ctypes.sizeof(ext4_inode):
+            # Inodes smaller than the structure lack the extra fields, they are padded in a copy
+            return ext4_inode._from_buffer_copy(raw)
+        return self.from_buffer(ext4_inode, raw)
 
     @property
     def root(self):
@@ -573,13 +744,15 @@ class Volume:
 
 
 class Inode:
-    def __init__(self, volume, offset, inode_idx, file_type=InodeType.UNKNOWN):
+    def __init__(self, volume, offset, inode_idx, file_type=InodeType.UNKNOWN, raw=None, inode=None):
         self.inode_idx = inode_idx
         self.offset = offset
         self.volume = volume
 
         self.file_type = file_type
-        self.inode = volume.read_struct(ext4_inode, offset)
+        # The s_inode_size bytes of the inode, extra fields and in-inode xattrs included
+        self.raw = volume.read(offset, volume.superblock.s_inode_size) if raw is None else raw
+        self.inode = volume.parse_inode(self.raw) if inode is None else inode
 
     def __len__(self):
         return self.inode.i_size
@@ -630,10 +803,11 @@ class Inode:
                 xattr_value = xattr_inode.open_read().read()
             else:
                 # internal xattr
-                xattr_value = raw_data[
-                              xattr_entry.e_value_offs + offset: xattr_entry.e_value_offs + offset + xattr_entry.e_value_size]
+                xattr_value = bytes(raw_data[
+                              xattr_entry.e_value_offs + offset: xattr_entry.e_value_offs + offset + xattr_entry.e_value_size])
 
-            yield xattr_name, xattr_value
+            # Equal values (mostly SELinux labels) are all the same object
+            yield xattr_name, self.volume.xattr_values.setdefault(xattr_value, xattr_value)
 
             i += xattr_entry._size
 
@@ -786,11 +960,17 @@ class Inode:
             mapping = []  # List of MappingEntry instances
 
             nodes = queue.Queue()
-            nodes.put_nowait(self.offset + ext4_inode.i_block.offset)
+            # The root node sits in i_block, the inode bytes are already read
+            nodes.put_nowait(None)
 
             while nodes.qsize() != 0:
-                header_offset = nodes.get_nowait()
-                header = self.volume.read_struct(ext4_extent_header, header_offset)
+                node_offset = nodes.get_nowait()
+                if node_offset is None:
+                    node = self.raw[ext4_inode.i_block.offset:ext4_inode.i_block.offset + ext4_inode.i_block.size]
+                else:
+                    # Other nodes take a whole block, header and entries are read at once
+                    node = self.volume.read(node_offset, self.volume.block_size)
+                header = self.volume.from_buffer(ext4_extent_header, node)
 
                 if not self.volume.ignore_magic and header.eh_magic != 0xF30A:
                     raise MagicError(
@@ -798,13 +978,13 @@ class Inode:
                         f" inode {self.inode_idx:d}: 0x{header.eh_magic:04X} (expected 0xF30A)")
 
                 if header.eh_depth != 0:
-                    indices = self.volume.read_struct(ext4_extent_idx * header.eh_entries,
-                                                      header_offset + ctypes.sizeof(ext4_extent_header))
+                    indices = self.volume.from_buffer(ext4_extent_idx * header.eh_entries, node,
+                                                      ctypes.sizeof(ext4_extent_header))
                     for idx in indices:
                         nodes.put_nowait(idx.ei_leaf * self.volume.block_size)
                 else:
-                    extents = self.volume.read_struct(ext4_extent * header.eh_entries,
-                                                      header_offset + ctypes.sizeof(ext4_extent_header))
+                    extents = self.volume.from_buffer(ext4_extent * header.eh_entries, node,
+                                                      ctypes.sizeof(ext4_extent_header))
                     for extent in extents:
                         mapping.append(MappingEntry(extent.ee_block, extent.ee_start, extent.ee_len))
 
@@ -812,8 +992,8 @@ class Inode:
             return BlockReader(self.volume, len(self), mapping)
         else:
             # Inode uses inline data
-            i_block = self.volume.read(self.offset + ext4_inode.i_block.offset, ext4_inode.i_block.size)
-            return io.BytesIO(i_block[:self.inode.i_size])
+            i_block = self.raw[ext4_inode.i_block.offset:ext4_inode.i_block.offset + ext4_inode.i_block.size]
+            return io.BytesIO(bytes(i_block[:self.inode.i_size]))
 
     @property
     def size_readable(self):
@@ -826,13 +1006,13 @@ class Inode:
             return f"{self.inode.i_size / (1024 ** unit_idx):.2f} {units[unit_idx - 1]:s}"
 
     def xattrs(self, check_inline=True, check_block=True, force_inline=False):
-        # Inline xattrs
-        inline_data_offset = self.offset + ext4_inode.EXT2_GOOD_OLD_INODE_SIZE + self.inode.i_extra_isize
-        inline_data_length = self.offset + self.volume.superblock.s_inode_size - inline_data_offset
+        # Inline xattrs, parsed from the inode bytes already read
+        inline_data_offset = ext4_inode.EXT2_GOOD_OLD_INODE_SIZE + self.inode.i_extra_isize
+        inline_data_length = self.volume.superblock.s_inode_size - inline_data_offset
 
         if check_inline and inline_data_length > ctypes.sizeof(ext4_xattr_ibody_header):
-            inline_data = self.volume.read(inline_data_offset, inline_data_length)
-            xattrs_header = ext4_xattr_ibody_header.from_buffer_copy(inline_data)
+            inline_data = self.raw[inline_data_offset:inline_data_offset + inline_data_length]
+            xattrs_header = self.volume.from_buffer(ext4_xattr_ibody_header, inline_data)
 
             # TODO Find way to detect inline xattrs without checking the h_magic field to enable error detection with
             #  the h_magic field.
@@ -847,27 +1027,45 @@ class Inode:
                 ...
         # xattr block(s)
         if check_block and self.inode.i_file_acl != 0:
-            xattrs_block_start = self.inode.i_file_acl * self.volume.block_size
-            xattrs_block = self.volume.read(xattrs_block_start, self.volume.block_size)
-            if xattrs_block:
-                xattrs_header = ext4_xattr_header.from_buffer_copy(xattrs_block)
-                if not self.volume.ignore_magic and xattrs_header.h_magic != 0xEA020000:
-                    # Perhaps you think this code is a bit foolish, but that's all others can do
-                    print(f"Invalid magic value in xattrs block header at offset 0x{xattrs_block_start:X} of "
-                          f"inode {self.inode_idx:d}: 0x{xattrs_header.h_magic} (expected 0xEA020000)")
-                    return '', ''
-
-                if xattrs_header.h_blocks != 1:
-                    print(f"Invalid number of xattr blocks at offset 0x{xattrs_block_start:X} "
-                          f"of inode {self.inode_idx:d}: {xattrs_header.h_blocks:d} (expected 1)")
-                    return '', ''
-
-            offset = 4 * ((ctypes.sizeof(
-                ext4_xattr_header) + 3) // 4)
-            # The ext4_xattr_entry following the header is aligned on a 4-byte boundary
-            for xattr_name, xattr_value in self._parse_xattrs(xattrs_block[offset:], -offset):
+            with self.volume.cache_lock:
+                block_xattrs = self.volume.xattr_blocks.get(self.inode.i_file_acl)
+                if block_xattrs is not None:
+                    self.volume.xattr_blocks.move_to_end(self.inode.i_file_acl)
+
+            if block_xattrs is None:
+                block_xattrs = self._read_xattr_block(self.inode.i_file_acl)
+                if block_xattrs is None:
+                    return
+                with self.volume.cache_lock:
+                    self.volume.xattr_blocks[self.inode.i_file_acl] = block_xattrs
+                    if len(self.volume.xattr_blocks) > self.volume.XATTR_BLOCK_CACHE_SIZE:
+                        self.volume.xattr_blocks.popitem(last=False)
+
+            for xattr_name, xattr_value in block_xattrs:
                 yield xattr_name, xattr_value
 
+    def _read_xattr_block(self, block_idx):
+        """(name, value) pairs of the xattr block, None if the block is invalid."""
+        xattrs_block_start = block_idx * self.volume.block_size
+        xattrs_block = self.volume.read(xattrs_block_start, self.volume.block_size)
+        if xattrs_block:
+            xattrs_header = self.volume.from_buffer(ext4_xattr_header, xattrs_block)
+            if not self.volume.ignore_magic and xattrs_header.h_magic != 0xEA020000:
+                # Perhaps you think this code is a bit foolish, but that's all others can do
+                print(f"Invalid magic value in xattrs block header at offset 0x{xattrs_block_start:X} of "
+                      f"inode {self.inode_idx:d}: 0x{xattrs_header.h_magic} (expected 0xEA020000)")
+                return None
+
+            if xattrs_header.h_blocks != 1:
+                print(f"Invalid number of xattr blocks at offset 0x{xattrs_block_start:X} "
+                      f"of inode {self.inode_idx:d}: {xattrs_header.h_blocks:d} (expected 1)")
+                return None
+
+        offset = 4 * ((ctypes.sizeof(
+            ext4_xattr_header) + 3) // 4)
+        # The ext4_xattr_entry following the header is aligned on a 4-byte boundary
+        return tuple(self._parse_xattrs(xattrs_block[offset:], -offset))
+
 
 class BlockReader:
     # OSError
@@ -884,21 +1082,91 @@ class BlockReader:
         # Optimize mapping (stich together)
         MappingEntry.optimize(block_map)
         self.block_map = block_map
+        # First file block of every mapping entry, block_map is sorted by it
+        self.block_starts = [entry.file_block_idx for entry in block_map]
 
     def __repr__(self):
         return f"{type(self).__name__:s}(byte_size = {self.byte_size!r:s}, block_map = {self.block_map!r:s}, volume_uuid = {self.volume.uuid!r:s})"
 
     def get_block_mapping(self, file_block_idx):
-        disk_block_idx = None
+        entry_idx = bisect.bisect_right(self.block_starts, file_block_idx) - 1
+        if entry_idx >= 0:
+            entry = self.block_map[entry_idx]
+            if file_block_idx < entry.file_block_idx + entry.block_count:
+                return entry.disk_block_idx + file_block_idx - entry.file_block_idx
+
+        return None
+
+    def map_runs(self, offset, byte_len):
+        """Yields (disk_offset, length) of the contiguous runs covering byte_len bytes from offset on.
+
+        disk_offset is None for blocks mapped by no entry (holes of sparse files), which read as zeros.
+        """
+        block_size = self.volume.block_size
+        end = offset + byte_len
+
+        while offset < end:
+            file_block_idx = offset // block_size
+            entry_idx = bisect.bisect_right(self.block_starts, file_block_idx) - 1
+            entry = self.block_map[entry_idx] if entry_idx >= 0 else None
+
+            if entry is not None and file_block_idx < entry.file_block_idx + entry.block_count:
+                run_end = min(end, (entry.file_block_idx + entry.block_count) * block_size)
+                yield (entry.disk_block_idx - entry.file_block_idx) * block_size + offset, run_end - offset
+            else:
+                # Hole up to the next mapped block
+                next_idx = entry_idx + 1
+                run_end = end if next_idx == len(self.block_starts) else \
+                    min(end, self.block_starts[next_idx] * block_size)
+                yield None, run_end - offset
 
-        # Find disk block
-        for entry in self.block_map:
-            if entry.file_block_idx <= file_block_idx < entry.file_block_idx + entry.block_count:
-                block_diff = file_block_idx - entry.file_block_idx
-                disk_block_idx = entry.disk_block_idx + block_diff
-                break
+            offset = run_end
+
+    @staticmethod
+    def check_run(length, read_len):
+        if read_len != length:
+            raise EndOfStreamError(
+                "The volume's underlying stream ended {0:d} bytes before EOF.".format(length - read_len))
+
+    def read_runs(self, offset, byte_len):
+        """Yields byte_len bytes from offset on as memoryview slices, one volume read per contiguous run of disk blocks."""
+        for disk_offset, length in self.map_runs(offset, byte_len):
+            if disk_offset is None:
+                yield memoryview(bytes(length))
+            else:
+                run = memoryview(self.volume.read(disk_offset, length))
+                self.check_run(length, len(run))
+                yield run
+
+    def readinto(self, buffer):
+        """Reads up to len(buffer) bytes at the cursor straight into buffer, returns the number of bytes read."""
+        view = memoryview(buffer).cast("B")
+        byte_len = max(0, min(len(view), self.byte_size - self.cursor))
+        position = 0
+
+        for disk_offset, length in self.map_runs(self.cursor, byte_len):
+            if disk_offset is None:
+                view[position:position + length] = bytes(length)
+            else:
+                self.check_run(length, self.volume.readinto(disk_offset, view[position:position + length]))
+            position += length
 
-        return disk_block_idx
+        self.cursor += position
+        return position
+
+    def iter_chunks(self, chunk_size=CHUNK_SIZE):
+        """Yields the rest of the file in chunks of at most chunk_size bytes, all read into one reused buffer.
+
+        A chunk is only valid until the next one is requested.
+        """
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+
+        while True:
+            read_len = self.readinto(buffer)
+            if not read_len:
+                break
+            yield view[:read_len]
 
     def read(self, byte_len=-1):
         # Parse args
@@ -911,25 +1179,13 @@ class BlockReader:
         if byte_len == 0:
             return b""
 
-        # Reading blocks
-        start_block_idx = self.cursor // self.volume.block_size
-        end_block_idx = (self.cursor + byte_len - 1) // self.volume.block_size
-        end_of_stream_check = byte_len
-
-        blocks = [self.read_block(i) for i in range(start_block_idx, end_block_idx - start_block_idx + 1)]
-
-        start_offset = self.cursor % self.volume.block_size
-        if start_offset != 0:
-            blocks[0] = blocks[0][start_offset:]
-        byte_len = (byte_len + start_offset - self.volume.block_size - 1) % self.volume.block_size + 1
-        blocks[-1] = blocks[-1][:byte_len]
-
-        result = b"".join(blocks)
-
-        # Check read
-        if len(result) != end_of_stream_check:
-            raise EndOfStreamError(
-                "The volume's underlying stream ended {0:d} bytes before EOF.".format(byte_len - len(result)))
+        runs = list(self.read_runs(self.cursor, byte_len))
+        # A file in one contiguous run read from the stream is returned as read, without another copy. Runs of the
+        # mapping are copied out, callers expect bytes.
+        if len(runs) == 1 and isinstance(runs[0].obj, bytes):
+            result = runs[0].obj
+        else:
+            result = b"".join(runs)
 
         self.cursor += len(result)
         return result
@@ -940,7 +1196,7 @@ class BlockReader:
         if disk_block_idx is not None:
             return self.volume.read(disk_block_idx * self.volume.block_size, self.volume.block_size)
         else:
-            return bytes([0] * self.volume.block_size)
+            return bytes(self.volume.block_size)
 
     def seek(self, seek, seek_mode=io.SEEK_SET):
         if seek_mode == io.SEEK_CUR:
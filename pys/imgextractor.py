@@ -4,6 +4,9 @@ import mmap
 import os
 import re
 import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
 
 if os.name == 'nt':
     from ctypes import windll
@@ -35,7 +38,10 @@ class EXT4_CHUNK_HEADER(object):
 
 class ULTRAMAN(object):
 
-    def __init__(self):
+    def __init__(self, workers=cpu_count(), budget=None):
+        self.workers = workers
+        # Semaphore shared with other work, every file being written holds a slot
+        self.budget = budget
         self.FileName = ''
         self.BASE_DIR = ''
         self.OUTPUT_IMAGE_FILE = ''
@@ -256,8 +262,8 @@ class ULTRAMAN(object):
 
     def EXT4_EXTRACTOR(self):
         CONFIGS_DIR = os.path.dirname(self.EXTRACT_DIR) + os.sep + 'config' + os.sep
-        if not os.path.isdir(CONFIGS_DIR):
-            os.mkdir(CONFIGS_DIR)
+        # Several images may be extracted at once into the same config directory
+        os.makedirs(CONFIGS_DIR, exist_ok=True)
         dna_contexts = CONFIGS_DIR + self.FileName + '_contexts.txt'
         dna_fsconfig = CONFIGS_DIR + self.FileName + '_fsconfig.txt'
         dna_info = CONFIGS_DIR + self.FileName + '_info.txt'
@@ -286,6 +292,37 @@ class ULTRAMAN(object):
         with codecs.open(dna_info, 'w', 'utf-8') as f:
             json.dump(manifest, f, indent=4)
 
+        # Files are streamed through one fixed-size buffer per worker, memory use does not grow with the file size
+        buffers = threading.local()
+        # File contents are written on the workers, the walk itself (directories, symlinks, fs_config and contexts)
+        # stays in order on this thread
+        file_jobs = []
+
+        def extract_file(entry_inode, file_target, mode, uid, gid):
+            if self.budget:
+                with self.budget:
+                    write_file(entry_inode, file_target, mode, uid, gid)
+            else:
+                write_file(entry_inode, file_target, mode, uid, gid)
+
+        def write_file(entry_inode, file_target, mode, uid, gid):
+            if not hasattr(buffers, 'view'):
+                buffers.buffer = bytearray(ext4.CHUNK_SIZE)
+                buffers.view = memoryview(buffers.buffer)
+            try:
+                reader = entry_inode.open_read()
+                with open(file_target, 'wb') as out:
+                    while True:
+                        read_len = reader.readinto(buffers.buffer)
+                        if not read_len:
+                            break
+                        out.write(buffers.view[:read_len])
+            except Exception and BaseException as e:
+                print(f'[E] Cannot Write to {file_target}, Reason: {e}')
+            if os.name == 'posix' and os.geteuid() == 0:
+                os.chmod(file_target, int(mode, 8))
+                os.chown(file_target, uid, gid)
+
         def scan_dir(root_inode, root_path=""):
             for entry_name, entry_inode_idx, entry_type in root_inode.open_dir():
                 if entry_name in ['.', '..'] or entry_name.endswith(' (2)'):
@@ -318,8 +355,8 @@ class ULTRAMAN(object):
                         link_target = entry_inode.open_read().read().decode("utf8")
                     except Exception and BaseException:
                         link_target_block = int.from_bytes(entry_inode.open_read().read(), "little")
-                        link_target = root_inode.volume.read(link_target_block * root_inode.volume.block_size,
-                                                             entry_inode.inode.i_size).decode("utf8")
+                        link_target = bytes(root_inode.volume.read(link_target_block * root_inode.volume.block_size,
+                                                                   entry_inode.inode.i_size)).decode("utf8")
                 if tmp_path.find(' ', 1, len(tmp_path)) > 0:
                     self.space.append(tmp_path)
                     self.fsconfig.append(
@@ -340,14 +377,7 @@ class ULTRAMAN(object):
                     scan_dir(entry_inode, entry_inode_path)
                 elif entry_inode.is_file:
                     file_target = self.EXTRACT_DIR + entry_inode_path.replace(' ', '_').replace('"', '')
-                    try:
-                        with open(file_target, 'wb') as out:
-                            out.write(entry_inode.open_read().read())
-                    except Exception and BaseException as e:
-                        print(f'[E] Cannot Write to {file_target}, Reason: {e}')
-                    if os.name == 'posix' and os.geteuid() == 0:
-                        os.chmod(file_target, int(mode, 8))
-                        os.chown(file_target, uid, gid)
+                    file_jobs.append(executor.submit(extract_file, entry_inode, file_target, mode, uid, gid))
                 elif entry_inode.is_symlink:
                     target = self.EXTRACT_DIR + entry_inode_path.replace(' ', '_')
                     try:
@@ -387,7 +417,11 @@ class ULTRAMAN(object):
 
         with open(self.OUTPUT_IMAGE_FILE, 'rb') as file:
             dir_r = self.FileName
-            scan_dir(ext4.Volume(file).root)
+            # The image is mapped while it is walked, closing the volume unmaps it before the image is touched again
+            with ext4.Volume(file, use_mmap=True) as volume, ThreadPoolExecutor(max_workers=self.workers) as executor:
+                scan_dir(volume.root)
+                for job in file_jobs:
+                    job.result()
             self.fsconfig.insert(0, '/ 0 2000 0755' if dir_r == 'vendor' else '/ 0 0 0755')
             self.fsconfig.insert(1, f'{dir_r} 0 2000 0755' if dir_r == 'vendor' else '/lost+found 0 0 0700')
             self.fsconfig.insert(2 if dir_r == 'system' else 1, f'{dir_r} 0 0 0755')
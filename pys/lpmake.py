@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+"""Layout and metadata of a logical partition (super) image, laid out the way lpmake and liblp's MetadataBuilder do.
+
+Only the metadata is built here: the geometry and metadata copies at the front of the device and the byte offset of
+every partition, whose data the caller writes in place.
+"""
+import hashlib
+import struct
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+from pys.lpunpack import LP_METADATA_GEOMETRY_MAGIC, LP_METADATA_GEOMETRY_SIZE, LP_METADATA_HEADER_MAGIC, \
+    LP_PARTITION_ATTR_READONLY, LP_PARTITION_RESERVED_BYTES, LP_SECTOR_SIZE, LP_TARGET_TYPE_LINEAR
+
+LP_METADATA_MAJOR_VERSION = 10
+LP_METADATA_VERSION_FOR_EXPANDED_HEADER = 2
+LP_HEADER_FLAG_VIRTUAL_AB_DEVICE = 0x1
+LP_DEFAULT_PARTITION_ALIGNMENT = 1024 * 1024
+LP_DEFAULT_METADATA_SIZE = 65536
+LP_DEFAULT_BLOCK_SIZE = 4096
+
+GEOMETRY = struct.Struct('<2I32s3I')
+# LpMetadataHeader up to the table descriptors (v1.0), v1.2 adds the flags and pads the header to 256 bytes
+HEADER = struct.Struct('<I2HI32sI32s12I')
+HEADER_V1_2_SIZE = 256
+PARTITION = struct.Struct('<36s4I')
+EXTENT = struct.Struct('<QIQI')
+GROUP = struct.Struct('<36sIQ')
+BLOCK_DEVICE = struct.Struct('<Q2IQ36sI')
+
+
+class LpMakeError(Exception):
+    """Raised when the partitions do not fit the super device"""
+
+
+def align_to(value, alignment):
+    return -(-value // alignment) * alignment
+
+
+@dataclass
+class LpPartition:
+    name: str
+    group: str
+    size: int
+    attributes: int = LP_PARTITION_ATTR_READONLY
+    # (num_sectors, first physical sector) of every linear extent
+    extents: List[Tuple[int, int]] = field(default_factory=list)
+
+
+class SuperLayout:
+    """Logical partitions allocated on a single super block device.
+
+    Partitions are given as (name, group, size) and groups as (name, maximum_size), both in table order. Every
+    partition gets one extent, allocated front to back at the partition alignment like a freshly built lpmake image.
+    Without a device_size, the device is made just large enough to hold them.
+    """
+
+    def __init__(self, partitions, groups, device_size=None, metadata_size=LP_DEFAULT_METADATA_SIZE,
+                 metadata_slots=2, alignment=LP_DEFAULT_PARTITION_ALIGNMENT, block_size=LP_DEFAULT_BLOCK_SIZE,
+                 virtual_ab=False, super_name="super"):
+        self.metadata_max_size = align_to(metadata_size, LP_SECTOR_SIZE)
+        self.metadata_slots = metadata_slots
+        self.alignment = alignment
+        self.block_size = block_size
+        self.virtual_ab = virtual_ab
+        self.super_name = super_name
+        # The default group takes index 0, as in liblp
+        self.groups: List[Tuple[str, int]] = [("default", 0)] + [tuple(group) for group in groups]
+        group_names = [name for name, _ in self.groups]
+        self.metadata_end = LP_PARTITION_RESERVED_BYTES + (
+                LP_METADATA_GEOMETRY_SIZE + self.metadata_max_size * metadata_slots) * 2
+        self.first_logical_sector = align_to(self.metadata_end, alignment) // LP_SECTOR_SIZE
+
+        self.partitions: List[LpPartition] = []
+        group_sizes: Dict[str, int] = {}
+        sector = self.first_logical_sector
+        for name, group, size in partitions:
+            if group not in group_names:
+                raise LpMakeError(f'Partition {name} is in an unknown group: {group}')
+            partition = LpPartition(name, group, align_to(size, block_size))
+            if partition.size:
+                sector = align_to(sector, alignment // LP_SECTOR_SIZE)
+                partition.extents.append((partition.size // LP_SECTOR_SIZE, sector))
+                sector += partition.size // LP_SECTOR_SIZE
+            group_sizes[group] = group_sizes.get(group, 0) + partition.size
+            self.partitions.append(partition)
+        for name, maximum_size in self.groups:
+            if maximum_size and group_sizes.get(name, 0) > maximum_size:
+                raise LpMakeError(f'Partitions of group {name} exceed its maximum size {maximum_size}')
+
+        end = align_to(max(sector * LP_SECTOR_SIZE, self.metadata_end), alignment)
+        self.device_size = device_size or end
+        if self.device_size < end:
+            raise LpMakeError(f'Partitions need {end} bytes, the super device only has {self.device_size}')
+        if self.device_size % block_size:
+            raise LpMakeError(f'Super device size {self.device_size} is not a multiple of the block size')
+
+    def offsets(self) -> Dict[str, int]:
+        """Byte offset of every partition with data, by partition name."""
+        return {partition.name: partition.extents[0][1] * LP_SECTOR_SIZE
+                for partition in self.partitions if partition.extents}
+
+    def geometry(self) -> bytes:
+        def pack(checksum):
+            return GEOMETRY.pack(LP_METADATA_GEOMETRY_MAGIC, GEOMETRY.size, checksum, self.metadata_max_size,
+                                 self.metadata_slots, self.block_size)
+
+        geometry = pack(hashlib.sha256(pack(bytes(32))).digest())
+        return geometry + bytes(LP_METADATA_GEOMETRY_SIZE - len(geometry))
+
+    def metadata(self) -> bytes:
+        """Header and tables of one metadata copy."""
+        group_index = {name: index for index, (name, _) in enumerate(self.groups)}
+        partitions = []
+        extents = []
+        for partition in self.partitions:
+            partitions.append(PARTITION.pack(partition.name.encode(), partition.attributes, len(extents),
+                                             len(partition.extents), group_index[partition.group]))
+            extents.extend(EXTENT.pack(num_sectors, LP_TARGET_TYPE_LINEAR, sector, 0)
+                           for num_sectors, sector in partition.extents)
+        groups = [GROUP.pack(name.encode(), 0, maximum_size) for name, maximum_size in self.groups]
+        block_devices = [BLOCK_DEVICE.pack(self.first_logical_sector, self.alignment, 0, self.device_size,
+                                           self.super_name.encode(), 0)]
+
+        descriptors = []
+        offset = 0
+        for table, entry in ((partitions, PARTITION), (extents, EXTENT), (groups, GROUP),
+                             (block_devices, BLOCK_DEVICE)):
+            descriptors += [offset, len(table), entry.size]
+            offset += len(table) * entry.size
+        tables = b''.join(partitions + extents + groups + block_devices)
+
+        flags = LP_HEADER_FLAG_VIRTUAL_AB_DEVICE if self.virtual_ab else 0
+        minor_version = LP_METADATA_VERSION_FOR_EXPANDED_HEADER if flags else 0
+        header_size = HEADER_V1_2_SIZE if flags else HEADER.size
+
+        def pack(checksum):
+            header = HEADER.pack(LP_METADATA_HEADER_MAGIC, LP_METADATA_MAJOR_VERSION, minor_version, header_size,
+                                 checksum, len(tables), hashlib.sha256(tables).digest(), *descriptors)
+            if header_size > HEADER.size:
+                header += struct.pack('<I', flags) + bytes(header_size - HEADER.size - 4)
+            return header
+
+        metadata = pack(hashlib.sha256(pack(bytes(32))).digest()) + tables
+        if len(metadata) > self.metadata_max_size:
+            raise LpMakeError(f'Metadata of {len(metadata)} bytes exceeds the maximum of {self.metadata_max_size}')
+        return metadata
+
+    def regions(self) -> List[Tuple[int, bytes]]:
+        """(offset, data) of the primary and backup geometry and of every metadata slot's primary and backup copy."""
+        geometry = self.geometry()
+        metadata = self.metadata()
+        base = LP_PARTITION_RESERVED_BYTES + LP_METADATA_GEOMETRY_SIZE * 2
+        regions = [(LP_PARTITION_RESERVED_BYTES, geometry),
+                   (LP_PARTITION_RESERVED_BYTES + LP_METADATA_GEOMETRY_SIZE, geometry)]
+        for slot in range(self.metadata_slots):
+            regions.append((base + self.metadata_max_size * slot, metadata))
+            regions.append((base + self.metadata_max_size * (self.metadata_slots + slot), metadata))
+        return regions
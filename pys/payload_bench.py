@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+"""Synthetic payload.bin generator and throughput harness for pys/dumper.py.
+
+    python -m pys.payload_bench generate bench/payload.bin --size system=192,vendor=48,boot=16
+    python -m pys.payload_bench run bench/payload.bin --modes slow,thread,process --output result.json
+    python -m pys.payload_bench run bench/payload.bin --baseline result.json
+
+Every mode runs in a fresh interpreter so peak RSS and CPU time are its own.
+"""
+import argparse
+import bz2
+import hashlib
+import json
+import lzma
+import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+import zstandard
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from pys import dumper
+from pys import update_metadata_pb2 as um
+
+MiB = 1 << 20
+# Relative weight of every kind of operation, SOURCE_COPY makes the payload incremental
+DEFAULT_MIX = {"REPLACE": 2, "REPLACE_XZ": 4, "REPLACE_BZ": 1, "REPLACE_ZSTD": 2, "ZERO": 1, "SOURCE_COPY": 0}
+# Dumper keyword arguments and run() keyword arguments of every benchmarked mode
+MODES = {
+    "slow": ({}, {"slow": True}),
+    "thread": ({"backend": "thread"}, {}),
+    "process": ({"backend": "process"}, {}),
+}
+
+
+def parse_pairs(text, value_type):
+    pairs = {}
+    for item in text.split(","):
+        name, value = item.split("=")
+        pairs[name.strip()] = value_type(value)
+    return pairs
+
+
+def block_data(rnd, count, block_size, compressibility):
+    # Each block is random bytes followed by a run of a repeated byte, compressibility is the share of the latter.
+    # Random.randbytes needs Python 3.9, getrandbits(0) fails before it.
+    random_size = block_size - int(block_size * compressibility)
+    return b''.join((rnd.getrandbits(8 * random_size).to_bytes(random_size, "little") if random_size else b'') +
+                    bytes([rnd.randrange(256)]) * (block_size - random_size)
+                    for _ in range(count))
+
+
+def generate(path, sizes, mix=None, compressibility=0.5, op_blocks=256, block_size=4096, seed=0, old=None):
+    """Writes a payload with a partition of sizes[name] MiB each, returns the generated images' SHA-256 by name.
+
+    SOURCE_COPY operations need source images, they are written to the old directory.
+    """
+    mix = mix or DEFAULT_MIX
+    kinds = [kind for kind in mix if mix[kind]]
+    weights = [mix[kind] for kind in kinds]
+    if "SOURCE_COPY" in kinds and not old:
+        raise ValueError("SOURCE_COPY operations need an old image directory")
+    rnd = random.Random(seed)
+    dam = um.DeltaArchiveManifest()
+    dam.block_size = block_size
+    dam.minor_version = 6 if old else 0
+    op = um.InstallOperation
+    digests = {}
+    data_path = path + ".data"
+    with open(data_path, 'wb') as data_file:
+        for name, size in sizes.items():
+            blocks = size * MiB // block_size
+            source = None
+            if old:
+                os.makedirs(old, exist_ok=True)
+                source = block_data(rnd, blocks, block_size, compressibility)
+                with open(f"{old}/{name}.img", 'wb') as f:
+                    f.write(source)
+            partition = dam.partitions.add()
+            partition.partition_name = name
+            sha256 = hashlib.sha256()
+            block = 0
+            while block < blocks:
+                count = min(rnd.randint(1, op_blocks), blocks - block)
+                kind = rnd.choices(kinds, weights)[0]
+                operation = partition.operations.add()
+                extent = operation.dst_extents.add()
+                extent.start_block = block
+                extent.num_blocks = count
+                if kind == "ZERO":
+                    operation.type = op.ZERO
+                    data = bytes(count * block_size)
+                elif kind == "SOURCE_COPY":
+                    operation.type = op.SOURCE_COPY
+                    start = rnd.randrange(blocks - count + 1)
+                    extent = operation.src_extents.add()
+                    extent.start_block = start
+                    extent.num_blocks = count
+                    data = source[start * block_size:(start + count) * block_size]
+                else:
+                    data = block_data(rnd, count, block_size, compressibility)
+                    if kind == "REPLACE_XZ":
+                        operation.type = op.REPLACE_XZ
+                        blob = lzma.compress(data)
+                    elif kind == "REPLACE_BZ":
+                        operation.type = op.REPLACE_BZ
+                        blob = bz2.compress(data)
+                    elif kind == "REPLACE_ZSTD":
+                        operation.type = op.REPLACE
+                        blob = zstandard.ZstdCompressor().compress(data)
+                    else:
+                        operation.type = op.REPLACE
+                        blob = data
+                    operation.data_offset = data_file.tell()
+                    operation.data_length = len(blob)
+                    operation.data_sha256_hash = hashlib.sha256(blob).digest()
+                    data_file.write(blob)
+                sha256.update(data)
+                block += count
+            partition.new_partition_info.size = blocks * block_size
+            partition.new_partition_info.hash = digests[name] = sha256.digest()
+    manifest = dam.SerializeToString()
+    with open(path, 'wb') as f:
+        f.write(b"CrAU" + struct.pack(">QQI", 2, len(manifest), 0) + manifest)
+        with open(data_path, 'rb') as data_file:
+            shutil.copyfileobj(data_file, f, MiB)
+    os.remove(data_path)
+    return digests
+
+
+def measure(payload, mode, workers, old=None):
+    """Runs one mode in this process, meant to be called in a fresh interpreter."""
+    dumper_kwargs, run_kwargs = MODES[mode]
+    out = tempfile.mkdtemp(prefix="payload_bench_")
+    try:
+        times = os.times()
+        start = time.perf_counter()
+        extractor = dumper.Dumper(payload, out, diff=old is not None, old=old, workers=workers, **dumper_kwargs)
+        ok = extractor.run(**run_kwargs)
+        seconds = time.perf_counter() - start
+        end_times = os.times()
+    finally:
+        shutil.rmtree(out, ignore_errors=True)
+    table_bytes = sum(extractor.partition_size(table) for table in extractor.tables.values())
+    operations = sum(len(table) for table in extractor.tables.values())
+    cpu = sum(end_times[:4]) - sum(times[:4])
+    max_process_rss = None
+    if resource:
+        # KiB on Linux, bytes on macOS. Children only report their largest peak, so with the process backend this is
+        # the peak of the largest single process (this one or a worker), not the total of all of them.
+        scale = 1 if sys.platform == "darwin" else 1024
+        max_process_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * scale / MiB
+    return {
+        "ok": ok,
+        "seconds": round(seconds, 3),
+        "mb_s": round(table_bytes / MiB / seconds, 2),
+        "ops_s": round(operations / seconds, 1),
+        "max_process_rss_mb": max_process_rss and round(max_process_rss, 1),
+        "cpu_util": round(cpu / seconds, 2),
+    }
+
+
+def bench(payload, modes, workers, repeat=1, old=None):
+    results = {}
+    for mode in modes:
+        runs = []
+        for _ in range(repeat):
+            command = [sys.executable, "-m", "pys.payload_bench", "measure", payload, mode, "--workers", str(workers)]
+            if old:
+                command += ["--old", old]
+            output = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True,
+                                    cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout
+            # Dumper prints its progress, the measurement is the last line
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+        results[mode] = min(runs, key=lambda result: result["seconds"])
+    return results
+
+
+def compare(results, baseline):
+    for mode, result in results.items():
+        base = baseline.get("modes", {}).get(mode)
+        if base:
+            result["baseline_mb_s"] = base["mb_s"]
+            result["speedup"] = round(result["mb_s"] / base["mb_s"], 2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Synthetic payload benchmark for pys/dumper.py")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = commands.add_parser("generate", help="write a synthetic payload.bin")
+    generate_parser.add_argument("payload")
+    generate_parser.add_argument("--size", default="system=48,vendor=12,boot=4", help="partition=MiB,...")
+    generate_parser.add_argument("--mix", help="operation=weight,... of " + ",".join(DEFAULT_MIX))
+    generate_parser.add_argument("--compressibility", type=float, default=0.5)
+    generate_parser.add_argument("--op-blocks", type=int, default=256, help="largest operation, in blocks")
+    generate_parser.add_argument("--old", help="directory for the source images of SOURCE_COPY operations")
+    generate_parser.add_argument("--seed", type=int, default=0)
+
+    run_parser = commands.add_parser("run", help="benchmark Dumper.run on a payload")
+    run_parser.add_argument("payload")
+    run_parser.add_argument("--modes", default=",".join(MODES))
+    run_parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    run_parser.add_argument("--repeat", type=int, default=1, help="runs per mode, the fastest is reported")
+    run_parser.add_argument("--old", help="source image directory of an incremental payload")
+    run_parser.add_argument("--baseline", help="result JSON of an earlier run to compare against")
+    run_parser.add_argument("--output", help="also write the result JSON here")
+
+    measure_parser = commands.add_parser("measure", help=argparse.SUPPRESS)
+    measure_parser.add_argument("payload")
+    measure_parser.add_argument("mode", choices=MODES)
+    measure_parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    measure_parser.add_argument("--old")
+
+    args = parser.parse_args(argv)
+    if args.command == "generate":
+        mix = parse_pairs(args.mix, int) if args.mix else None
+        generate(args.payload, parse_pairs(args.size, int), mix, args.compressibility, args.op_blocks,
+                 seed=args.seed, old=args.old)
+    elif args.command == "measure":
+        print(json.dumps(measure(args.payload, args.mode, args.workers, args.old)))
+    else:
+        result = {
+            "payload": args.payload,
+            "payload_bytes": os.path.getsize(args.payload),
+            "workers": args.workers,
+            "modes": bench(args.payload, args.modes.split(","), args.workers, args.repeat, args.old),
+        }
+        if args.baseline:
+            with open(args.baseline) as f:
+                compare(result["modes"], json.load(f))
+        text = json.dumps(result, indent=2)
+        print(text)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
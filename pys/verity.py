@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""dm-verity hash tree and FEC data as update_engine writes them after installing a partition.
+
+Both follow the Android tools bit for bit: the hash tree of libverity's HashTreeBuilder (salted digests, levels
+padded to whole blocks and stored top level first) and the Reed-Solomon parity of libfec as written by
+VerityWriterAndroid::EncodeFEC.
+"""
+import hashlib
+from functools import partial
+
+# libfec: RS(255, 255 - roots) over GF(2^8) with FEC_PARAMS(roots) = 8, 0x11d, fcr 0, prim 1, roots, pad 0
+FEC_RSM = 255
+FEC_GFPOLY = 0x11D
+FEC_BLOCKSIZE = 4096
+# Rounds of FEC encoded together, each round is one block of codewords
+FEC_BATCH_ROUNDS = 16
+HASH_CHUNK = 1 << 20
+
+
+def hash_blocks(salted, block_size, data):
+    """Concatenated digests of salt + block for every block of data."""
+    view = memoryview(data)
+    digests = []
+    for pos in range(0, len(view), block_size):
+        digest = salted.copy()
+        digest.update(view[pos:pos + block_size])
+        digests.append(digest.digest())
+    return b''.join(digests)
+
+
+def build_hash_tree(read, data_size, block_size, algorithm, salt, executor):
+    """Returns the hash tree over data_size bytes, read(length, offset) reads the data.
+
+    Every level is split into chunks hashed on the executor, hashlib releases the GIL while digesting a block.
+    """
+    salted = hashlib.new(algorithm or "sha256", salt)
+    hash_chunk = partial(hash_blocks, salted, block_size)
+    offsets = range(0, data_size, HASH_CHUNK)
+    level = b''.join(executor.map(lambda offset: hash_chunk(read(min(HASH_CHUNK, data_size - offset), offset)),
+                                  offsets))
+    levels = []
+    while True:
+        level += bytes(-len(level) % block_size)
+        levels.append(level)
+        if len(level) <= block_size:
+            break
+        chunks = [level[pos:pos + HASH_CHUNK] for pos in range(0, len(level), HASH_CHUNK)]
+        level = b''.join(executor.map(hash_chunk, chunks))
+    return b''.join(reversed(levels))
+
+
+class ReedSolomon:
+    """Systematic RS encoder of libfec's encode_rs_char, run on many codewords at once.
+
+    Byte i of every codeword sits in one column. The shift register then works on whole columns: a GF multiply
+    by a constant is bytes.translate with a 256-byte table, the XOR is done on big integers.
+    """
+
+    def __init__(self, roots, gfpoly=FEC_GFPOLY, fcr=0, prim=1):
+        self.roots = roots
+        alpha_to = [0] * 256
+        index_of = [0] * 256
+        index_of[0] = FEC_RSM
+        sr = 1
+        for i in range(FEC_RSM):
+            index_of[sr] = i
+            alpha_to[i] = sr
+            sr <<= 1
+            if sr & 0x100:
+                sr ^= gfpoly
+            sr &= FEC_RSM
+        genpoly = [1] + [0] * roots
+        root = fcr * prim
+        for i in range(roots):
+            genpoly[i + 1] = 1
+            for j in range(i, 0, -1):
+                if genpoly[j]:
+                    genpoly[j] = genpoly[j - 1] ^ alpha_to[(index_of[genpoly[j]] + root) % FEC_RSM]
+                else:
+                    genpoly[j] = genpoly[j - 1]
+            genpoly[0] = alpha_to[(index_of[genpoly[0]] + root) % FEC_RSM]
+            root += prim
+
+        def multiply_table(coefficient):
+            if not coefficient:
+                return bytes(256)
+            log = index_of[coefficient]
+            return bytes([0] + [alpha_to[(index_of[x] + log) % FEC_RSM] for x in range(1, 256)])
+
+        # Tables of the feedback terms in shift order: parity[j] takes genpoly[roots - j], the last one genpoly[0]
+        self.tables = [multiply_table(genpoly[roots - j]) for j in range(1, roots)] + [multiply_table(genpoly[0])]
+
+    def encode_columns(self, columns):
+        """Parity columns of the codewords whose data bytes are given column by column."""
+        length = len(columns[0])
+        roots = self.roots
+        parity = [0] * roots
+        for column in columns:
+            feedback = (int.from_bytes(column, "big") ^ parity[0]).to_bytes(length, "big")
+            for j in range(1, roots):
+                parity[j - 1] = parity[j] ^ int.from_bytes(feedback.translate(self.tables[j - 1]), "big")
+            parity[roots - 1] = int.from_bytes(feedback.translate(self.tables[roots - 1]), "big")
+        return [value.to_bytes(length, "big") for value in parity]
+
+
+def build_fec(read, data_size, block_size, roots):
+    """Yields the FEC data over data_size bytes round by round, block_size * roots bytes each."""
+    rs_n = FEC_RSM - roots
+    rounds = -(-(data_size // block_size) // rs_n)
+    rs = ReedSolomon(roots)
+    zero_block = bytes(block_size)
+    for first in range(0, rounds, FEC_BATCH_ROUNDS):
+        batch = range(first, min(rounds, first + FEC_BATCH_ROUNDS))
+        rs_blocks = []
+        for i in batch:
+            # Block j of round i comes from the interleaved offset, past the end of the data reads as zeros
+            offsets = (i * block_size + j * rounds * FEC_BLOCKSIZE for j in range(rs_n))
+            rs_blocks.append([read(block_size, offset) if offset < data_size else zero_block for offset in offsets])
+        # Codeword k of a round is byte k of each of its rs_n blocks, so block j is the column of data byte j
+        columns = [b''.join(blocks[j] for blocks in rs_blocks) for j in range(rs_n)]
+        parity = rs.encode_columns(columns)
+        for n in range(len(batch)):
+            buffer = bytearray(block_size * roots)
+            for p in range(roots):
+                buffer[p::roots] = parity[p][n * block_size:(n + 1) * block_size]
+            yield bytes(buffer)